@@ -0,0 +1,21 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks. Run them from the top of the repository, for example:
+
+    python -m bench.codec
+"""
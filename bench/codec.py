@@ -0,0 +1,104 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares the typed message codec against the old dynamic-attribute Message
+with MessageEncoder/json_loads.
+"""
+from __future__ import print_function
+import json
+import timeit
+import messages
+
+#
+# The old implementation, kept here for comparison.
+#
+class _LegacyMessage(object):
+    def __init__(self, verb, **kwargs):
+        if isinstance(verb, _LegacyMessage):
+            for k in dir(verb):
+                if not k.startswith('_'):
+                    setattr(self, k, getattr(verb, k))
+        else:
+            self.verb = verb.upper()
+            for k, v in kwargs.items():
+                setattr(self, k, v)
+
+    def _for_json(self):
+        return dict((x, getattr(self, x)) for x in dir(self) if not x.startswith('_'))
+
+def _legacy_from_json(d):
+    if 'verb' not in d:
+        return d
+
+    x = _LegacyMessage(d['verb'])
+    for k, v in d.items():
+        if not k.startswith('_'):
+            setattr(x, k, v)
+    return x
+
+class _LegacyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if not hasattr(obj, '_for_json'):
+            return super(json.JSONEncoder, self).default(obj)
+
+        return obj._for_json()
+
+def legacy_dumps(obj):
+    return json.dumps(obj, cls=_LegacyEncoder)
+
+def legacy_loads(data):
+    return json.loads(data, object_hook=_legacy_from_json)
+
+#
+# Benchmark
+#
+POINTS = [[100 + i, 200 + (i * 7) % 50] for i in range(20)]
+
+def _draw_json():
+    return json.dumps({'verb': 'DRAW', 'points': POINTS})
+
+def _run(name, stmt, number):
+    elapsed = min(timeit.repeat(stmt, number=number, repeat=3))
+    rate = number / elapsed
+    print('{:<28} {:>12,.0f} ops/s'.format(name, rate))
+    return rate
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Message codec microbenchmark')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='iterations per measurement')
+    parser.add_argument('--backend', default='json',
+                        choices=sorted(messages.BACKENDS),
+                        help='JSON backend for the typed codec')
+    args = parser.parse_args()
+
+    messages.set_backend(args.backend)
+    data = _draw_json()
+    legacy = _LegacyMessage('DRAWN', points=POINTS)
+    typed = messages.Drawn(points=POINTS)
+
+    print('DRAW with {} points, backend {}'.format(len(POINTS), args.backend))
+    old_loads = _run('legacy decode', lambda: legacy_loads(data), args.number)
+    new_loads = _run('typed decode', lambda: messages.decode(data), args.number)
+    old_dumps = _run('legacy encode', lambda: legacy_dumps(legacy), args.number)
+    new_dumps = _run('typed encode', lambda: messages.encode(typed), args.number)
+    print('decode speedup: {:.2f}x'.format(new_loads / old_loads))
+    print('encode speedup: {:.2f}x'.format(new_dumps / old_dumps))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In-process stand-ins for Redis and Postgres so the game server can be
+benchmarked without either. Call `install()` before importing `sketch`.
+"""
+import json
+import os
+from contextlib import contextmanager
+from gevent.queue import Queue
+
+class FakePubSub(object):
+    """Just enough of redis-py's PubSub for SketchBackend"""
+    def __init__(self, server):
+        self.server = server
+        self.channels = {}
+        self._queue = Queue()
+
+    def subscribe(self, *args, **kwargs):
+        for channel in args:
+            kwargs[channel] = None
+        for channel, handler in kwargs.items():
+            self.channels[_b(channel)] = handler
+            self.server.subscribers.setdefault(_b(channel), set()).add(self)
+
+    def unsubscribe(self, *args):
+        for channel in args:
+            self.channels.pop(_b(channel), None)
+            self.server.subscribers.get(_b(channel), set()).discard(self)
+
+    def _deliver(self, channel, data):
+        self._queue.put({'type': 'message', 'pattern': None,
+                            'channel': channel, 'data': data})
+
+    def listen(self):
+        while True:
+            msg = self._queue.get()
+            handler = self.channels.get(msg['channel'])
+            if handler is None:
+                yield msg
+            else:
+                handler(msg)
+
+def _b(value):
+    """
+    Converts an argument to the bytes Redis would store for it.
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    return value.encode('utf-8')
+
+def _slice(items, start, end):
+    """
+    Applies a Redis-style inclusive range to a list.
+    """
+    n = len(items)
+    if start < 0:
+        start = max(n + start, 0)
+    if end < 0:
+        end = n + end
+    return items[start:end + 1]
+
+class FakePipeline(object):
+    """Queues up commands and runs them all on execute()"""
+    def __init__(self, server):
+        self.server = server
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.server, name)
+        def queue(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+class FakeRedis(object):
+    """
+    An in-memory Redis with the commands the game server uses. The Lua
+    scripts in `scripts` are emulated in Python.
+    """
+    def __init__(self):
+        import scripts
+        self.subscribers = {}
+        self.data = {}
+        self._scripts = {scripts.STATE: self._state,
+                            scripts.JOIN: self._join,
+                            scripts.DEPART: self._depart,
+                            scripts.GUESS: self._guess,
+                            scripts.SKIP: self._skip,
+                            scripts.PASS: self._pass,
+                            scripts.END: self._end,
+                            scripts.DEAL: self._deal,
+                            scripts.SWEEP: self._sweep}
+
+    # Pub/sub
+    def pubsub(self):
+        return FakePubSub(self)
+
+    def publish(self, channel, data):
+        subscribers = self.subscribers.get(_b(channel), ())
+        for pubsub in list(subscribers):
+            pubsub._deliver(_b(channel), _b(data))
+        return len(subscribers)
+
+    def execute_command(self, *args, **options):
+        return getattr(self, args[0].lower())(*args[1:])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, source):
+        emulation = self._scripts[source]
+        def script(keys=[], args=[], client=None):
+            return emulation([_b(k) for k in keys], [_b(a) for a in args])
+        return script
+
+    # Keys and strings
+    def exists(self, key):
+        return _b(key) in self.data
+
+    def delete(self, *keys):
+        return sum(self.data.pop(_b(k), None) is not None for k in keys)
+
+    def get(self, key):
+        return self.data.get(_b(key))
+
+    def set(self, key, value):
+        self.data[_b(key)] = _b(value)
+        return True
+
+    def setnx(self, key, value):
+        if _b(key) in self.data:
+            return False
+        return self.set(key, value)
+
+    # Lists
+    def _list(self, key):
+        return self.data.setdefault(_b(key), [])
+
+    def _cleanup(self, key):
+        if not self.data.get(_b(key), True):
+            del self.data[_b(key)]              # Redis drops empty keys
+
+    def rpush(self, key, *values):
+        items = self._list(key)
+        items.extend(_b(v) for v in values)
+        return len(items)
+
+    def lpop(self, key):
+        items = self.data.get(_b(key))
+        if not items:
+            return None
+        value = items.pop(0)
+        self._cleanup(key)
+        return value
+
+    def lindex(self, key, index):
+        items = self.data.get(_b(key), [])
+        try:
+            return items[index]
+        except IndexError:
+            return None
+
+    def lrange(self, key, start, end):
+        return _slice(self.data.get(_b(key), []), start, end)
+
+    def ltrim(self, key, start, end):
+        if _b(key) in self.data:
+            self.data[_b(key)] = _slice(self.data[_b(key)], start, end)
+            self._cleanup(key)
+        return True
+
+    def llen(self, key):
+        return len(self.data.get(_b(key), []))
+
+    # Sets
+    def sadd(self, key, *values):
+        members = self.data.setdefault(_b(key), set())
+        before = len(members)
+        members.update(_b(v) for v in values)
+        return len(members) - before
+
+    def smembers(self, key):
+        return set(self.data.get(_b(key), ()))
+
+    def scard(self, key):
+        return len(self.data.get(_b(key), ()))
+
+    # Sorted sets
+    def zadd(self, key, *args, **kwargs):
+        scores = self.data.setdefault(_b(key), {})
+        pairs = list(zip(args[::2], args[1::2])) + list(kwargs.items())
+        added = 0
+        for member, score in pairs:
+            added += _b(member) not in scores
+            scores[_b(member)] = float(score)
+        return added
+
+    def zrem(self, key, *members):
+        scores = self.data.get(_b(key), {})
+        removed = sum(scores.pop(_b(m), None) is not None for m in members)
+        self._cleanup(key)
+        return removed
+
+    def zcard(self, key):
+        return len(self.data.get(_b(key), ()))
+
+    def zscore(self, key, member):
+        return self.data.get(_b(key), {}).get(_b(member))
+
+    def zincrby(self, key, member, amount=1):
+        scores = self.data.setdefault(_b(key), {})
+        scores[_b(member)] = scores.get(_b(member), 0) + float(amount)
+        return scores[_b(member)]
+
+    def zrange(self, key, start, end, withscores=False):
+        scores = self.data.get(_b(key), {})
+        ordered = sorted(scores.items(), key=lambda x: (x[1], x[0]))
+        ordered = _slice(ordered, start, end)
+        if withscores:
+            return ordered
+        return [m for m, _ in ordered]
+
+    def zrangebyscore(self, key, low, high, start=None, num=None):
+        scores = self.data.get(_b(key), {})
+        low, high = float(low), float(high)
+        ordered = sorted((s, m) for m, s in scores.items() if low <= s <= high)
+        if start is not None:
+            ordered = ordered[int(start):int(start) + int(num)]
+        return [m for _, m in ordered]
+
+    def zremrangebyscore(self, key, low, high):
+        scores = self.data.get(_b(key), {})
+        low, high = float(low), float(high)
+        doomed = [m for m, s in scores.items() if low <= s <= high]
+        for member in doomed:
+            del scores[member]
+        self._cleanup(key)
+        return len(doomed)
+
+    # Scripts, mirroring the Lua in scripts.py
+    def _first(self, key):
+        first = self.zrange(key, 0, 0)
+        return first[0] if first else None
+
+    def _state(self, keys, args):
+        turns, word, end = keys
+        return [self._first(turns), self.get(word), self.get(end)]
+
+    def _join(self, keys, args):
+        players, turns, word, end, leases = keys
+        name, now, end_time, lease, expires = args
+        others = self.zrange(players, 0, -1)
+        if self.zscore(players, name) is None:
+            self.zadd(players, name, 0)
+            self.zadd(turns, name, now)
+        self.zadd(leases, lease, expires)
+
+        artist = self._first(turns)
+        current = None
+        if artist == name:
+            current = self.get(word)
+            self.setnx(end, end_time)
+        return [others, artist, current, self.get(end)]
+
+    def _depart(self, keys, args):
+        players, turns, skip, leases = keys
+        name, lease = args
+        self.zrem(players, name)
+        self.data.get(skip, set()).discard(name)
+        self._cleanup(skip)
+        self.zrem(leases, lease)
+        if self._first(turns) == name:
+            return 1
+        self.zrem(turns, name)
+        return 0
+
+    def _guess(self, keys, args):
+        turns, word, players = keys
+        expected, guesser, guess = args
+        artist = self._first(turns)
+        current = self.get(word)
+        if artist != expected or guesser == artist or current is None:
+            return [0, current, None]
+        if current.lower() != guess.lower():
+            return [0, current, None]
+        return [1, current, _b(self.zincrby(players, guesser))]
+
+    def _skip(self, keys, args):
+        turns, skip, players = keys
+        if self._first(turns) != args[0]:
+            return 0
+        return int(self.scard(skip) * 2 > self.zcard(players) - 1)
+
+    def _pass(self, keys, args):
+        turns, word, skip, end, players, canvas, deck = keys
+        artist, end_time, now, reset = args
+        if self._first(turns) != artist:
+            return None
+        new_word = self.lpop(deck)
+        if new_word is None:
+            return 0
+        nxt = self.zrange(turns, 1, 1)
+        nxt = nxt[0] if nxt else artist
+
+        self.set(word, new_word)
+        self.delete(skip)
+        self.set(end, end_time)
+        self.delete(canvas)
+        self.rpush(canvas, end_time)
+        if reset == '1':
+            for player in self.zrange(players, 0, -1):
+                self.zadd(players, player, 0)
+        if self.zscore(players, artist) is not None:
+            self.zadd(turns, artist, now)
+        else:
+            self.zrem(turns, artist)
+        return [nxt, new_word, self.llen(deck)]
+
+    def _end(self, keys, args):
+        turns, end = keys
+        artist, now = args
+        end_time = self.get(end)
+        if self._first(turns) != artist or end_time is None \
+                or float(end_time) > float(now):
+            return 0
+        self.delete(end)
+        return 1
+
+    def _deal(self, keys, args):
+        deck, dealt = keys
+        for word in args:
+            if self.sadd(dealt, word):
+                self.rpush(deck, word)
+        return self.llen(deck)
+
+    def _sweep(self, keys, args):
+        leases, = keys
+        now, most = args
+        swept = []
+        for lease in self.zrangebyscore(leases, '-inf', now, 0, most):
+            name, player = [_b(x) for x in json.loads(lease)]
+            prefix = b'table.' + name + b'.'
+            drawing = 0
+            if self._first(prefix + b'turns') == player:
+                drawing = 1
+            else:
+                self.zrem(prefix + b'turns', player)
+            self.zrem(prefix + b'players', player)
+            self.data.get(prefix + b'skip', set()).discard(player)
+            self._cleanup(prefix + b'skip')
+            self.zrem(leases, lease)
+            swept.append([name, player, drawing])
+        return swept
+
+def install(words=1000):
+    """
+    Points the models at an in-memory SQLite database holding `words` words,
+    and makes redis.from_url hand out a FakeRedis.
+    """
+    os.environ.setdefault('REDISCLOUD_URL', 'redis://localhost:6379')
+    os.environ.setdefault('DATABASE_URL', 'postgres://bench@localhost/bench')
+
+    import redis
+    from peewee import SqliteDatabase
+    import models
+
+    class FakeDatabase(SqliteDatabase):
+        @contextmanager
+        def checkout(self):
+            yield
+
+    db = FakeDatabase(':memory:')
+    models.db = db
+    models.Word._meta.database = db
+    models.Word.create_table()
+    with db.transaction():
+        for i in range(words):
+            models.Word.create(text='word{}'.format(i), plays=0, wins=0)
+
+    # Word stats are flushed with Postgres-only SQL. Throw them away.
+    import wordstats
+    def flush(self):
+        self._drain()
+        self._pending = {}
+    wordstats.WordStats.flush = flush
+
+    server = FakeRedis()
+    redis.from_url = lambda url, **kwargs: server
+    return server
@@ -0,0 +1,256 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Puts one worker under load from simulated players.
+
+Each simulated player is handed to the /game handler as its WebSocket and
+speaks the real protocol: CONNECT and JOIN, then DRAW and PASS while it's the
+artist, and GUESS while it isn't. Redis and Postgres are replaced by the
+fakes in bench.fakes, so everything runs in one process.
+
+Every stroke carries its sequence number and table, so the time from DRAW to
+each DRAWN gives the fan-out latency. Spectators, if any, just watch. Save a
+run with --save; compare against it with --baseline, which exits non-zero if
+anything got worse by more than --tolerance.
+"""
+from __future__ import print_function
+import json
+import random
+import resource
+import sys
+import time
+import gevent
+from gevent.queue import Queue
+from bench import fakes
+
+# Lower is better for these; higher for the rest.
+LOWER_IS_BETTER = ('p50_ms', 'p99_ms', 'kb_per_connection')
+
+class Run(object):
+    """What the simulated players saw"""
+    def __init__(self):
+        self.sent = {}                          # (table, seq) -> time
+        self.latencies = []
+        self.messages_in = 0                    # Sent by players
+        self.frames_out = 0                     # Sent to players
+        self.measuring = False
+
+class Client(object):
+    """A simulated browser, and the server's WebSocket for it"""
+    def __init__(self, run, name, table, number, spectate=False):
+        self.run = run
+        self.name = name
+        self.table = table
+        self.number = number                    # Table number, for strokes
+        self.spectate = spectate
+        self.artist = False
+        self.closed = False
+        self._inbox = Queue()
+
+    # The server's side
+    def receive(self):
+        return self._inbox.get()
+
+    def send(self, data, binary=False):
+        run = self.run
+        if run.measuring:
+            run.frames_out += 1
+        if 'DRAWN' in data:
+            self._drawn(json.loads(data))
+        elif 'PASSED' in data:
+            msg = json.loads(data)
+            self.artist = msg['player_name'] == self.name and 'word' in msg
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._inbox.put(None)
+
+    # The browser's side
+    def _drawn(self, msg):
+        now = time.time()
+        lines = msg.get('strokes') or [msg['points']]
+        for line in lines:
+            sent = self.run.sent.get((line[0][1], line[0][0]))
+            if sent is not None and self.run.measuring:
+                self.run.latencies.append(now - sent)
+
+    def _say(self, **msg):
+        if self.run.measuring:
+            self.run.messages_in += 1
+        self._inbox.put(json.dumps(msg))
+
+    def play(self, until, stroke_rate, turn, guess_interval):
+        self._say(verb='CONNECT', player_name=self.name)
+        if self.spectate:
+            self._say(verb='JOIN', table=self.table, spectate=True)
+            gevent.sleep(max(0, until - time.time()))
+            return
+        self._say(verb='JOIN', table=self.table)
+
+        seq = 0
+        drawn = 0
+        next_guess = time.time() + random.random() * guess_interval
+        while time.time() < until and not self.closed:
+            if self.artist:
+                seq = (seq + 1) % 30000
+                points = [[seq, self.number]]
+                points.extend([random.randrange(500), random.randrange(500)]
+                                for _ in range(4))
+                self.run.sent[(self.number, seq)] = time.time()
+                self._say(verb='DRAW', points=points)
+                drawn += 1
+                if drawn >= turn:
+                    drawn = 0
+                    self.artist = False
+                    self._say(verb='PASS')
+                gevent.sleep(1.0 / stroke_rate)
+            else:
+                drawn = 0
+                now = time.time()
+                if now >= next_guess:
+                    self._say(verb='GUESS', word='nope')
+                    next_guess = now + guess_interval
+                gevent.sleep(min(0.05, max(0, next_guess - now)))
+
+def _rss():
+    """
+    Returns the resident set size in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+def _compare(result, baseline, tolerance):
+    """
+    Prints each result against the baseline. Returns whether any of them
+    got worse by more than `tolerance`.
+    """
+    worse = False
+    for key in sorted(baseline):
+        if key not in result or not isinstance(baseline[key], float):
+            continue
+        before, after = baseline[key], result[key]
+        if not before:
+            continue
+        change = (after - before) / before
+        if key in LOWER_IS_BETTER:
+            change = -change
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            worse = True
+        print('{:>20}: {:>12,.2f} -> {:>12,.2f} ({:+.0%}){}'.format(
+                                            key, before, after, change, flag))
+    return worse
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulated player load test')
+    parser.add_argument('-t', '--tables', type=int, default=20)
+    parser.add_argument('-p', '--players', type=int, default=5,
+                        help='players per table')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help='seconds to measure for')
+    parser.add_argument('-s', '--spectators', type=int, default=0,
+                        help='spectators per table')
+    parser.add_argument('--stroke-rate', type=float, default=20,
+                        help='strokes per second from each artist')
+    parser.add_argument('--turn', type=int, default=100,
+                        help='strokes before the artist passes')
+    parser.add_argument('--guess-interval', type=float, default=2,
+                        help='seconds between guesses from each player')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against saved results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='how much worse than the baseline is too much')
+    args = parser.parse_args()
+
+    fakes.install()
+    import sketch
+
+    run = Run()
+    warmup = 2.0
+    until = time.time() + warmup + args.duration
+    rss_before = _rss()
+
+    clients = []
+    for t in range(args.tables):
+        for p in range(args.players):
+            client = Client(run, 'player{}-{}'.format(t, p),
+                            'table{}'.format(t), t)
+            clients.append(client)
+            gevent.spawn(sketch.game, client)
+            gevent.spawn(client.play, until, args.stroke_rate, args.turn,
+                            args.guess_interval)
+        for s in range(args.spectators):
+            client = Client(run, 'spectator{}-{}'.format(t, s),
+                            'table{}'.format(t), t, spectate=True)
+            clients.append(client)
+            gevent.spawn(sketch.game, client)
+            gevent.spawn(client.play, until, args.stroke_rate, args.turn,
+                            args.guess_interval)
+
+    gevent.sleep(warmup)
+    rss_after = _rss()
+    run.measuring = True
+    start = time.time()
+    gevent.sleep(max(0, until - start))
+    elapsed = time.time() - start
+    run.measuring = False
+    for client in clients:
+        client.close()
+
+    result = {
+        'players': args.tables * args.players,
+        'spectators': args.tables * args.spectators,
+        'tables': args.tables,
+        'messages_per_second': run.messages_in / elapsed,
+        'frames_per_second': run.frames_out / elapsed,
+        'p50_ms': _percentile(run.latencies, 0.50) * 1000,
+        'p99_ms': _percentile(run.latencies, 0.99) * 1000,
+        'kb_per_connection': (rss_after - rss_before) / 1024.0 / len(clients),
+    }
+
+    print('{players} players and {spectators} spectators at {tables} tables '
+            'for {:.1f}s'.format(elapsed, **result))
+    print('  in:  {messages_per_second:,.0f} messages/s'.format(**result))
+    print('  out: {frames_per_second:,.0f} frames/s'.format(**result))
+    print('  fan-out latency: p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms '
+            '({} samples)'.format(len(run.latencies), **result))
+    print('  memory: {kb_per_connection:,.1f} KB per connection'.format(
+                                                                    **result))
+
+    worse = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            worse = _compare(result, json.load(f), args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    sys.exit(1 if worse else 0)
+
+if __name__ == '__main__':
+    main()
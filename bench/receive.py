@@ -0,0 +1,100 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures how many messages per second Player.run can receive, decode and
+dispatch on one worker. Save a run with --save and compare a later one
+against it with --baseline to see the difference a change makes.
+"""
+from __future__ import print_function
+import json
+import time
+from bench import fakes
+
+class FakeSocket(object):
+    """A WebSocket that hands out a fixed list of frames, then fails"""
+    def __init__(self, frames):
+        self._frames = iter(frames)
+
+    def receive(self):
+        try:
+            return next(self._frames)
+        except StopIteration:
+            raise IOError('connection closed')
+
+    def send(self, data, binary=False):
+        pass
+
+    def close(self):
+        pass
+
+class StubTable(object):
+    """Swallows everything the player asks of its table"""
+    def __init__(self):
+        self.calls = 0
+
+    def _call(self, *args):
+        self.calls += 1
+
+    draw = draw_strokes = guess = skip_turn = pass_turn = _call
+    leave = disconnect = _call
+
+def _frames(count):
+    points = [[100 + i, 200 + (i * 7) % 50] for i in range(10)]
+    draw = json.dumps({'verb': 'DRAW', 'points': points})
+    guess = json.dumps({'verb': 'GUESS', 'word': 'apple'})
+    keepalive = json.dumps({'verb': 'KEEPALIVE'})
+    mix = [draw] * 8 + [guess, keepalive]
+    return [mix[i % len(mix)] for i in range(count)]
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Player receive loop benchmark')
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='messages to push through the loop')
+    parser.add_argument('--save', help='write the result to this file')
+    parser.add_argument('--baseline', help='compare against a saved result')
+    args = parser.parse_args()
+
+    fakes.install()
+    import sketch
+
+    frames = _frames(args.number)
+    table = StubTable()
+    player = sketch.Player(sketch.sketches, FakeSocket(frames))
+    player.name = 'bench'
+    player.table = table
+
+    start = time.time()
+    player.run()
+    elapsed = time.time() - start
+
+    rate = args.number / elapsed
+    print('{:,} messages in {:.2f}s: {:,.0f} messages/s'.format(args.number,
+                                                                elapsed, rate))
+    assert(table.calls >= args.number * 9 // 10)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            before = json.load(f)['messages_per_second']
+        print('baseline {:,.0f} messages/s, {:.2f}x'.format(before,
+                                                            rate / before))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'messages_per_second': rate}, f)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Decides which instance owns each table.
+
+Live instances heartbeat into a sorted set in Redis, and every instance builds
+the same consistent-hash ring from its members. A table's owner is the only
+instance that runs its game; the others forward it what it needs to know.
+"""
+import atexit
+import bisect
+import hashlib
+import logging
+import struct
+import time
+import gevent
+import metrics
+
+log = logging.getLogger(__name__)
+
+NODES_KEY = 'cluster.nodes'
+
+nodes_gauge = metrics.gauge('cluster_nodes', 'Live instances in the ring')
+rebalances = metrics.counter('cluster_rebalances_total',
+                                'Times the ring changed')
+heartbeat_errors = metrics.counter('cluster_heartbeat_errors_total',
+                                    'Heartbeats that failed')
+
+def _hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+
+class HashRing(object):
+    """
+    Maps keys onto nodes. Each node is placed on the ring `replicas` times,
+    so adding or removing one only moves the keys next to its points.
+    """
+    def __init__(self, nodes=(), replicas=64):
+        self.nodes = frozenset(nodes)
+        points = sorted((_hash('{}#{}'.format(node, i)), node)
+                        for node in self.nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def owner(self, key):
+        """
+        Returns the node that owns `key`, or None if the ring is empty.
+        """
+        if not self._hashes:
+            return None
+        idx = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[idx]
+
+class Cluster(object):
+    """
+    This instance's membership in the ring.
+
+    A heartbeat every `interval` seconds keeps this node in NODES_KEY, drops
+    nodes that haven't been heard from in `ttl` seconds, and rebuilds the ring
+    if the membership changed. Callbacks registered with `on_heartbeat` run
+    after each one, told whether the ring changed.
+    """
+    def __init__(self, client, node_id, interval=5, ttl=15, replicas=64):
+        self.client = client
+        self.node_id = node_id
+        self.channel = self.node_channel(node_id)
+        self.interval = interval
+        self.ttl = ttl
+        self.replicas = replicas
+        self.ring = HashRing([node_id], replicas)
+        self._callbacks = []
+
+    @staticmethod
+    def node_channel(node_id):
+        """
+        Returns the channel that messages for `node_id` are sent on.
+        """
+        return 'node.' + node_id
+
+    def owner(self, key):
+        return self.ring.owner(key) or self.node_id
+
+    def owns(self, key):
+        return self.owner(key) == self.node_id
+
+    def on_heartbeat(self, callback):
+        self._callbacks.append(callback)
+
+    def heartbeat(self):
+        """
+        Renews this node's membership and refreshes the ring. Returns whether
+        the ring changed.
+        """
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.zadd(NODES_KEY, **{self.node_id: now})
+        pipe.zremrangebyscore(NODES_KEY, '-inf', now - self.ttl)
+        pipe.zrange(NODES_KEY, 0, -1)
+        nodes = pipe.execute()[-1]
+
+        changed = frozenset(nodes) != self.ring.nodes
+        if changed:
+            log.info('ring changed: %s', ', '.join(sorted(nodes)))
+            self.ring = HashRing(nodes, self.replicas)
+            nodes_gauge.set(len(nodes))
+            rebalances.inc()
+        return changed
+
+    def leave(self):
+        """
+        Takes this node out of the ring so others don't wait out its ttl.
+        """
+        try:
+            self.client.zrem(NODES_KEY, self.node_id)
+        except Exception:
+            log.exception('leaving the ring failed')
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                changed = self.heartbeat()
+            except Exception:
+                heartbeat_errors.inc()
+                log.exception('heartbeat failed')
+                continue
+
+            for callback in self._callbacks:
+                try:
+                    callback(changed)
+                except Exception:
+                    log.exception('heartbeat callback failed')
+
+    def start(self):
+        self.heartbeat()
+        metrics.greenlets.track(gevent.spawn(self.run))
+        atexit.register(self.leave)
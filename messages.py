@@ -0,0 +1,269 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Typed messages sent over WebSocket connections and Redis.
+
+Every verb has its own class with a fixed set of slots and a small schema.
+`decode` turns JSON straight into the right class, checking the schema as it
+goes, and `encode` turns one back into JSON.
+"""
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+try:
+    text = basestring
+    number = (int, long, float)
+except NameError:
+    text = str
+    number = (int, float)
+
+class MessageError(ValueError):
+    """Raised when a message can't be decoded or doesn't match its schema"""
+
+#
+# JSON backends
+#
+def _stdlib_backend():
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    return encoder.encode, json.loads
+
+def _simplejson_backend():
+    import simplejson
+    encoder = simplejson.JSONEncoder(separators=(',', ':'))
+    return encoder.encode, simplejson.loads
+
+def _ujson_backend():
+    import ujson
+    return ujson.dumps, ujson.loads
+
+BACKENDS = {'json': _stdlib_backend,
+            'simplejson': _simplejson_backend,
+            'ujson': _ujson_backend}
+
+dumps, loads = _stdlib_backend()
+
+def set_backend(name):
+    """
+    Switches the JSON library used to encode and decode messages. Raises
+    ImportError if the library isn't installed.
+    """
+    global dumps, loads
+    dumps, loads = BACKENDS[name]()
+
+#
+# Messages
+#
+class Message(object):
+    """
+    A message that was or will be sent over a WebSocket connection.
+
+    Subclasses list their fields in __slots__, the ones that must be present
+    in `required`, and the types each field may have in `schema`.
+    """
+    __slots__ = ()
+    verb = None
+    required = ()
+    schema = {}
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError('{} has no fields {}'.format(self.verb,
+                                                        ', '.join(kwargs)))
+
+    def copy(self, **changes):
+        """
+        Returns a copy of this message with some fields changed.
+        """
+        x = self.__class__.__new__(self.__class__)
+        for name in self.__slots__:
+            setattr(x, name, changes.pop(name, getattr(self, name)))
+        if changes:
+            raise TypeError('{} has no fields {}'.format(self.verb,
+                                                        ', '.join(changes)))
+        return x
+
+    def to_dict(self):
+        d = {'verb': self.verb}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                d[name] = value
+        return d
+
+    def __repr__(self):
+        fields = ', '.join('{}={!r}'.format(k, getattr(self, k))
+                            for k in self.__slots__)
+        return '{}({})'.format(self.__class__.__name__, fields)
+
+# Sent by the browser
+class Keepalive(Message):
+    __slots__ = ()
+    verb = 'KEEPALIVE'
+
+class Connect(Message):
+    __slots__ = ('player_name', 'binary_strokes')
+    verb = 'CONNECT'
+    required = ('player_name',)
+    schema = {'player_name': text, 'binary_strokes': bool}
+
+class Join(Message):
+    __slots__ = ('table', 'spectate')
+    verb = 'JOIN'
+    required = ('table',)
+    schema = {'table': text, 'spectate': bool}
+
+class Leave(Message):
+    __slots__ = ()
+    verb = 'LEAVE'
+
+class Pass(Message):
+    __slots__ = ()
+    verb = 'PASS'
+
+class Skip(Message):
+    __slots__ = ()
+    verb = 'SKIP'
+
+class Draw(Message):
+    __slots__ = ('points',)
+    verb = 'DRAW'
+    required = ('points',)
+    schema = {'points': list}
+
+class Guess(Message):
+    __slots__ = ('word',)
+    verb = 'GUESS'
+    required = ('word',)
+    schema = {'word': text}
+
+# Sent by the server
+class Joined(Message):
+    __slots__ = ('player_name',)
+    verb = 'JOINED'
+    required = ('player_name',)
+    schema = {'player_name': text}
+
+class Departed(Message):
+    __slots__ = ('player_name', 'disconnected')
+    verb = 'DEPARTED'
+    required = ('player_name',)
+    schema = {'player_name': text, 'disconnected': bool}
+
+class Passed(Message):
+    __slots__ = ('player_name', 'end_time', 'word', 'guesser', 'score')
+    verb = 'PASSED'
+    required = ('player_name',)
+    schema = {'player_name': text, 'end_time': number, 'word': text,
+                'guesser': text, 'score': number}
+
+class Skipped(Message):
+    __slots__ = ('player_name',)
+    verb = 'SKIPPED'
+    required = ('player_name',)
+    schema = {'player_name': text}
+
+class Drawn(Message):
+    __slots__ = ('points', 'strokes')
+    verb = 'DRAWN'
+    schema = {'points': list, 'strokes': list}
+
+class Guessed(Message):
+    __slots__ = ('player_name', 'word', 'correct')
+    verb = 'GUESSED'
+    required = ('player_name', 'word')
+    schema = {'player_name': text, 'word': text, 'correct': bool}
+
+class Won(Message):
+    __slots__ = ('player_name',)
+    verb = 'WON'
+    required = ('player_name',)
+    schema = {'player_name': text}
+
+class Canvas(Message):
+    __slots__ = ('strokes',)
+    verb = 'CANVAS'
+    required = ('strokes',)
+    schema = {'strokes': list}
+
+class Ended(Message):
+    __slots__ = ('player_name',)
+    verb = 'ENDED'
+    schema = {'player_name': text}
+
+# Sent between instances
+class Claim(Message):
+    __slots__ = ('table',)
+    verb = 'CLAIM'
+    required = ('table',)
+    schema = {'table': text}
+
+class Yield(Message):
+    __slots__ = ('table', 'player_name')
+    verb = 'YIELD'
+    required = ('table', 'player_name')
+    schema = {'table': text, 'player_name': text}
+
+VERBS = dict((cls.verb, cls) for cls in (Keepalive, Connect, Join, Leave,
+                                            Pass, Skip, Draw, Guess, Joined,
+                                            Departed, Passed, Skipped, Drawn,
+                                            Guessed, Won, Canvas, Ended,
+                                            Claim, Yield))
+
+def decode(data):
+    """
+    Decodes a JSON message into an instance of the class for its verb. Raises
+    MessageError if the JSON is bad or the message doesn't fit its schema.
+    """
+    try:
+        obj = loads(data)
+    except ValueError as e:
+        raise MessageError('invalid JSON: {}'.format(e))
+
+    try:
+        cls = VERBS[obj['verb'].upper()]
+    except (TypeError, KeyError, AttributeError):
+        raise MessageError('missing or unknown verb')
+
+    msg = cls.__new__(cls)
+    schema = cls.schema
+    for name in cls.__slots__:
+        value = obj.get(name)
+        if value is None:
+            if name in cls.required:
+                raise MessageError('{} missing {}'.format(cls.verb, name))
+        elif not isinstance(value, schema[name]):
+            raise MessageError('{} has bad {}'.format(cls.verb, name))
+        setattr(msg, name, value)
+    return msg
+
+def encode(msg):
+    """
+    Encodes a message as JSON.
+    """
+    return dumps(msg.to_dict())
+
+_backend = os.environ.get('JSON_BACKEND')
+if _backend:
+    try:
+        set_backend(_backend)
+    except ImportError:
+        log.warning('JSON backend %s is not installed, using json', _backend)
@@ -0,0 +1,215 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In-process metrics, rendered in the Prometheus text format by `render()`.
+"""
+import bisect
+import time
+from collections import OrderedDict
+
+registry = OrderedDict()
+
+class Counter(object):
+    """A value that only ever goes up"""
+    type = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+class Gauge(object):
+    """A value that can go up and down, or be read from a function"""
+    type = 'gauge'
+
+    def __init__(self, name, help='', function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def track(self, greenlet):
+        """
+        Counts `greenlet` until it exits, however it exits. Returns it.
+        """
+        self.inc()
+        greenlet.link(lambda _: self.dec())
+        return greenlet
+
+    def samples(self):
+        if self.function is not None:
+            return [('', (), self.function())]
+        return [('', (), self.value)]
+
+class Summary(object):
+    """Tracks the count, total and maximum of some observed quantity"""
+    type = 'summary'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        return [('_count', (), self.count), ('_sum', (), self.total)]
+
+class Histogram(object):
+    """Counts observations into buckets by their upper bounds"""
+    type = 'histogram'
+    BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                5, 10)
+
+    def __init__(self, name, help='', buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # Last one is +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            samples.append(('_bucket', (('le', str(bound)),), cumulative))
+        samples.append(('_count', (), self.count))
+        samples.append(('_sum', (), self.total))
+        return samples
+
+class Family(object):
+    """Metrics of one kind, told apart by the values of their labels"""
+    def __init__(self, kind, name, help, labels, **kwargs):
+        self.kind = kind
+        self.type = kind.type
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._kwargs = kwargs
+        self._children = OrderedDict()
+
+    def labels(self, *values):
+        try:
+            return self._children[values]
+        except KeyError:
+            child = self.kind(self.name, self.help, **self._kwargs)
+            self._children[values] = child
+            return child
+
+    def samples(self):
+        samples = []
+        for values, child in self._children.items():
+            labels = tuple(zip(self.labelnames, values))
+            for suffix, extra, value in child.samples():
+                samples.append((suffix, labels + extra, value))
+        return samples
+
+class _Timer(object):
+    def __init__(self, metric):
+        self.metric = metric
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metric.observe(time.time() - self.start)
+
+def _get(cls, name, help, labels=None, **kwargs):
+    try:
+        metric = registry[name]
+    except KeyError:
+        if labels:
+            metric = Family(cls, name, help, labels, **kwargs)
+        else:
+            metric = cls(name, help, **kwargs)
+        registry[name] = metric
+    assert(getattr(metric, 'kind', type(metric)) is cls)
+    return metric
+
+def counter(name, help='', labels=None):
+    return _get(Counter, name, help, labels)
+
+def gauge(name, help='', labels=None, function=None):
+    if function is not None:
+        return _get(Gauge, name, help, labels, function=function)
+    return _get(Gauge, name, help, labels)
+
+def summary(name, help='', labels=None):
+    return _get(Summary, name, help, labels)
+
+def histogram(name, help='', labels=None, buckets=Histogram.BUCKETS):
+    return _get(Histogram, name, help, labels, buckets=buckets)
+
+greenlets = gauge('greenlets', 'Live greenlets, counted as they are spawned')
+
+def _escape(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                            .replace('\n', '\\n'))
+
+def render():
+    """
+    Returns every registered metric in the Prometheus text format.
+    """
+    lines = []
+    for name, metric in registry.items():
+        lines.append(u'# HELP {} {}'.format(name, metric.help))
+        lines.append(u'# TYPE {} {}'.format(name, metric.type))
+        for suffix, labels, value in metric.samples():
+            if labels:
+                labels = u','.join(u'{}="{}"'.format(k, _escape(v))
+                                    for k, v in labels)
+                labels = u'{' + labels + u'}'
+            else:
+                labels = u''
+            lines.append(u'{}{}{} {}'.format(name, suffix, labels,
+                                                repr(float(value))))
+    return u'\n'.join(lines) + u'\n'
@@ -16,15 +16,187 @@
 # along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
 from peewee import *
 import os
+import time
 import urlparse
+from contextlib import contextmanager
+import gevent.socket
+from gevent.local import local
+from gevent.lock import BoundedSemaphore
+import psycopg2
+from psycopg2 import extensions
+import metrics
+
+# Most connections open at once, seconds to wait for one before giving up,
+# and how long a connection can sit idle before it's checked before reuse.
+POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 10))
+POOL_CHECK_AFTER = float(os.environ.get('DATABASE_POOL_CHECK_AFTER', 30))
+
+pool_wait = metrics.summary('db_pool_wait_seconds',
+                            'Time spent waiting for a free connection')
+pool_timeouts = metrics.counter('db_pool_timeouts_total',
+                                'Gave up waiting for a free connection')
+pool_open = metrics.gauge('db_pool_connections', 'Open connections')
+pool_in_use = metrics.gauge('db_pool_connections_in_use',
+                            'Connections checked out of the pool')
+pool_discarded = metrics.counter('db_pool_discarded_total',
+                                    'Broken connections thrown away')
+query_latency = metrics.histogram('db_query_seconds',
+                                    'Time spent running queries')
+
+def _wait(conn, timeout=None):
+    """
+    Lets other greenlets run while psycopg2 waits on the server.
+    """
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        elif state == extensions.POLL_READ:
+            gevent.socket.wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            gevent.socket.wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError('bad poll state: {}'.format(state))
+
+extensions.set_wait_callback(_wait)
+
+class PooledPostgresqlDatabase(PostgresqlDatabase):
+    """
+    A PostgresqlDatabase that gives each greenlet a connection of its own,
+    taken from a pool of at most `max_connections`.
+
+    A greenlet's connection goes back to the pool when it calls close(), or
+    at the end of a `checkout()` block. Connections that have been idle for
+    more than `check_after` seconds are tested before being handed out again.
+    """
+    def __init__(self, database, max_connections=10, timeout=10,
+                    check_after=30, **kwargs):
+        kwargs['threadlocals'] = True
+        super(PooledPostgresqlDatabase, self).__init__(database, **kwargs)
+
+        # peewee keeps the connection, autocommit and transaction state in a
+        # private thread local. Make it a greenlet local, patched or not.
+        self._local = self._Database__local = local()
+
+        self.timeout = timeout
+        self.check_after = check_after
+        self._slots = BoundedSemaphore(max_connections)
+        self._idle = []                         # (connection, idle since)
+
+    def connect(self):
+        # No lock: waiting for a free connection mustn't hold up close().
+        with self.exception_wrapper():
+            self._local.conn = self._connect(self.database,
+                                                **self.connect_kwargs)
+            self._local.closed = False
+
+    def close(self):
+        if getattr(self._local, 'closed', True):
+            return
+        self._local.closed = True
+        with self.exception_wrapper():
+            self._close(self._local.conn)
+
+    @contextmanager
+    def checkout(self):
+        """
+        Holds a connection for the length of the block. Blocks can be nested;
+        the connection is returned when the outermost one ends.
+        """
+        outermost = self.is_closed()
+        if outermost:
+            self.connect()
+        try:
+            yield
+        finally:
+            if outermost:
+                self.close()
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        with query_latency.time():
+            return super(PooledPostgresqlDatabase, self).execute_sql(
+                                                sql, params, require_commit)
+
+    def _connect(self, database, **kwargs):
+        start = time.time()
+        if not self._slots.acquire(timeout=self.timeout):
+            pool_timeouts.inc()
+            raise OperationalError('no free connection after {}s'.format(
+                                                                self.timeout))
+        pool_wait.observe(time.time() - start)
+
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = super(PooledPostgresqlDatabase, self)._connect(database,
+                                                                    **kwargs)
+                pool_open.inc()
+        except:
+            self._slots.release()
+            raise
+        pool_in_use.inc()
+        return conn
+
+    def _take_idle(self):
+        """
+        Returns a working idle connection, or None if there aren't any.
+        """
+        now = time.time()
+        while self._idle:
+            conn, since = self._idle.pop()
+            if not conn.closed and (now - since < self.check_after
+                                    or self._healthy(conn)):
+                return conn
+            self._discard(conn)
+        return None
+
+    def _healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        pool_open.dec()
+        pool_discarded.inc()
+
+    def _close(self, conn):
+        pool_in_use.dec()
+        try:
+            if not conn.closed:
+                status = conn.get_transaction_status()
+                if status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()             # Don't hand on a transaction
+        except psycopg2.Error:
+            pass
+
+        if conn.closed or \
+                conn.get_transaction_status() != \
+                    extensions.TRANSACTION_STATUS_IDLE:
+            self._discard(conn)
+        else:
+            self._idle.append((conn, time.time()))
+        self._slots.release()
 
 urlparse.uses_netloc.append('postgres')
 db_url = urlparse.urlparse(os.environ['DATABASE_URL'])
-db = PostgresqlDatabase(db_url.path[1:],
-                        user=db_url.username,
-                        password=db_url.password,
-                        host=db_url.hostname,
-                        port=db_url.port)
+db = PooledPostgresqlDatabase(db_url.path[1:],
+                                max_connections=POOL_SIZE,
+                                timeout=POOL_TIMEOUT,
+                                check_after=POOL_CHECK_AFTER,
+                                user=db_url.username,
+                                password=db_url.password,
+                                host=db_url.hostname,
+                                port=db_url.port)
 
 class BaseModel(Model):
     """The base class for all models"""
@@ -0,0 +1,136 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Leases on the players each instance has at its tables.
+
+Every player at a table holds a lease in LEASES_KEY, a sorted set scored by
+when the lease runs out. The instance the player is connected to renews it on
+every heartbeat, so if the instance dies its players' leases lapse, and the
+next sweep by any instance takes them out of their tables. Sweeping reads the
+set from its oldest end, so it only ever touches leases that have run out.
+"""
+import json
+import logging
+import time
+import gevent
+import metrics
+from scripts import SWEEP
+
+log = logging.getLogger(__name__)
+
+LEASES_KEY = 'presence.leases'
+
+leases_gauge = metrics.gauge('presence_leases', 'Leases held by this worker')
+renewed = metrics.counter('presence_renewals_total', 'Leases renewed')
+lapsed = metrics.counter('presence_lapsed_total',
+                            'Leases found swept while still held')
+expired = metrics.counter('presence_expired_total',
+                            'Players swept after their lease ran out')
+heartbeat_errors = metrics.counter('presence_heartbeat_errors_total',
+                                    'Renewals or sweeps that failed')
+
+def lease(table, player):
+    """
+    Returns the member of LEASES_KEY for `player` at `table`.
+    """
+    return json.dumps([table, player], separators=(',', ':'))
+
+class Presence(object):
+    """
+    This instance's leases.
+
+    Every `interval` seconds, the pairs returned by `held()` have their leases
+    extended to `ttl` seconds from now, and up to `batch` expired leases at a
+    time are swept. Each swept (table, player, was drawing) is passed to
+    `on_expired`. Any held lease that had already been swept, say because
+    Redis couldn't be reached for a while, is passed to `on_lapsed` as
+    (table, player) so the player can be put back.
+    """
+    def __init__(self, client, ttl=30, interval=10, batch=100):
+        self.client = client
+        self.ttl = ttl
+        self.interval = interval
+        self.batch = batch
+        self._sweep = client.register_script(SWEEP)
+
+    def expiry(self):
+        """
+        Returns when a lease granted or renewed now runs out.
+        """
+        return time.time() + self.ttl
+
+    def renew(self, pairs):
+        """
+        Extends the leases on the given (table, player) pairs. Returns the
+        ones that had been swept.
+        """
+        pairs = list(pairs)
+        leases_gauge.set(len(pairs))
+        if not pairs:
+            return []
+
+        expires = self.expiry()
+        pipe = self.client.pipeline(transaction=False)
+        for table, player in pairs:
+            pipe.zadd(LEASES_KEY, **{lease(table, player): expires})
+        added = pipe.execute()
+        renewed.inc(len(pairs))
+        return [pair for pair, new in zip(pairs, added) if new]
+
+    def sweep(self):
+        """
+        Takes every player whose lease has run out out of their table.
+        Returns (table, player, was drawing) for each.
+        """
+        swept = []
+        while True:
+            batch = self._sweep(keys=[LEASES_KEY],
+                                args=[time.time(), self.batch])
+            swept.extend((t.decode('utf-8'), p.decode('utf-8'), bool(d))
+                            for t, p, d in batch)
+            if len(batch) < self.batch:
+                break
+        expired.inc(len(swept))
+        return swept
+
+    def heartbeat(self, held, on_expired, on_lapsed):
+        for pair in self.renew(held()):
+            lapsed.inc()
+            log.warning('lease for %s at %s lapsed', pair[1], pair[0])
+            self._call(on_lapsed, *pair)
+        for entry in self.sweep():
+            log.info('lease for %s at %s expired', entry[1], entry[0])
+            self._call(on_expired, *entry)
+
+    def _call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            log.exception('presence callback failed')
+
+    def run(self, held, on_expired, on_lapsed):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.heartbeat(held, on_expired, on_lapsed)
+            except Exception:
+                heartbeat_errors.inc()
+                log.exception('presence heartbeat failed')
+
+    def start(self, held, on_expired, on_lapsed):
+        metrics.greenlets.track(gevent.spawn(self.run, held, on_expired,
+                                                on_lapsed))
@@ -0,0 +1,67 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A sampling profiler for a live worker.
+
+Every `interval` seconds of CPU time, SIGPROF interrupts whichever greenlet
+is running and its stack is counted. The result is in the collapsed format
+flamegraph.pl and speedscope read: one line per distinct stack, frames
+separated by semicolons, followed by how many samples landed there.
+"""
+import os
+import signal
+from collections import Counter
+
+class Sampler(object):
+    """Counts the stacks seen on SIGPROF while running"""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = False
+        self._previous = None
+
+    def start(self):
+        if self.running:
+            raise RuntimeError('already sampling')
+        self.running = True
+        self.stacks = Counter()
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+        self.running = False
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                        code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[';'.join(stack)] += 1
+
+    def collapsed(self):
+        """
+        Returns the samples in the collapsed stack format.
+        """
+        return ''.join('{} {}\n'.format(stack, count)
+                        for stack, count in self.stacks.most_common())
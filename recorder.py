@@ -0,0 +1,366 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Records table events to disk, and plays them back.
+
+Each table is recorded into its own directory as a series of segment files,
+named for when they were started. A segment is a header followed by blocks:
+
+    magic, version
+    compressed size, size       (little-endian uint32)
+    zlib compressed records
+    ...
+
+and each record inside a block is the time it was seen, its length and the
+event exactly as it came through the table's topic:
+
+    time                        (little-endian double)
+    length                      (little-endian uint32)
+    data
+
+Events are gathered into blocks in memory and handed to a writer greenlet,
+which compresses and writes them on a worker thread. Nothing that records an
+event ever waits on the disk: if the writer falls too far behind, blocks are
+dropped and counted instead.
+
+Run as a script to export a recording as JSON lines, or replay it at some
+multiple of the speed it was played at, either as JSON lines or into an empty
+table for spectators to watch.
+"""
+import glob
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import urllib
+import zlib
+import gevent
+from gevent.queue import Queue, Full
+import metrics
+import strokes
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'SWUR'
+VERSION = 1
+HEADER = struct.Struct('<4sI')
+BLOCK = struct.Struct('<II')
+RECORD = struct.Struct('<dI')
+SUFFIX = '.swr'
+
+recorded = metrics.counter('recorder_events_total', 'Table events recorded')
+dropped = metrics.counter('recorder_events_dropped_total',
+                            'Table events dropped while the writer was behind')
+written = metrics.counter('recorder_bytes_written_total',
+                            'Compressed bytes written to segments')
+write_errors = metrics.counter('recorder_write_errors_total',
+                                'Blocks that could not be written')
+queued = metrics.gauge('recorder_queue_blocks',
+                        'Blocks waiting to be written')
+
+class RecordingError(ValueError):
+    """Raised when a file isn't a recording this version can read"""
+
+class _Buffer(object):
+    """Records for one table that haven't been handed to the writer"""
+    __slots__ = ('records', 'size')
+
+    def __init__(self):
+        self.records = []
+        self.size = 0
+
+class _Segment(object):
+    """The segment file a table is being recorded into"""
+    __slots__ = ('f', 'size')
+
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(HEADER.pack(MAGIC, VERSION))
+        self.size = HEADER.size
+
+def table_dir(directory, table):
+    """
+    Returns the directory the named table is recorded into.
+    """
+    if not isinstance(table, bytes):
+        table = table.encode('utf-8')
+    return os.path.join(directory, urllib.quote(table, safe=''))
+
+def _segment_path(path, started):
+    return os.path.join(path, '{:013d}{}'.format(started, SUFFIX))
+
+class Recorder(object):
+    """
+    Appends table events to segment files under `directory`.
+
+    Events are compressed in blocks of about `block_size` bytes, and blocks
+    still being filled are written out every `flush_interval` seconds. A new
+    segment is started once one reaches `segment_size` bytes. At most
+    `backlog` blocks wait for the writer.
+    """
+    def __init__(self, directory, block_size=65536, segment_size=64 << 20,
+                    flush_interval=1.0, backlog=1000, level=6):
+        self.directory = directory
+        self.block_size = block_size
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.level = level
+        self._buffers = {}                      # table -> _Buffer
+        self._queue = Queue(backlog)            # (table, payload, count)
+        self._segments = {}                     # table -> _Segment, writer's
+
+    def record(self, table, data, when=None):
+        """
+        Records that `data` was sent to the named table.
+        """
+        if when is None:
+            when = time.time()
+        buf = self._buffers.get(table)
+        if buf is None:
+            buf = self._buffers[table] = _Buffer()
+        buf.records.append(RECORD.pack(when, len(data)))
+        buf.records.append(data)
+        buf.size += RECORD.size + len(data)
+        if buf.size >= self.block_size:
+            self._flush(table)
+
+    def close(self, table):
+        """
+        Writes out what's left for the named table and closes its segment.
+        """
+        self._flush(table)
+        self._put((table, None, 0))
+
+    def _flush(self, table):
+        buf = self._buffers.pop(table, None)
+        if buf is not None:
+            self._put((table, b''.join(buf.records), len(buf.records) // 2))
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            dropped.inc(item[2])
+            return
+        queued.inc()
+
+    def _write(self, table, payload):
+        """
+        Compresses and appends a block to the named table's segment, or
+        closes the segment if there's no block. Runs on a worker thread.
+        Returns how many bytes were written.
+        """
+        segment = self._segments.get(table)
+        if payload is None:
+            if segment is not None:
+                del self._segments[table]
+                segment.f.close()
+            return 0
+
+        if segment is not None and segment.size >= self.segment_size:
+            segment.f.close()
+            segment = None
+        if segment is None:
+            path = table_dir(self.directory, table)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            started = int(time.time() * 1000)
+            while os.path.exists(_segment_path(path, started)):
+                started += 1
+            segment = _Segment(_segment_path(path, started))
+            self._segments[table] = segment
+
+        block = zlib.compress(payload, self.level)
+        segment.f.write(BLOCK.pack(len(block), len(payload)))
+        segment.f.write(block)
+        segment.f.flush()
+        segment.size += BLOCK.size + len(block)
+        return BLOCK.size + len(block)
+
+    def _run_writer(self):
+        threadpool = gevent.get_hub().threadpool
+        for table, payload, count in self._queue:
+            queued.dec()
+            try:
+                written.inc(threadpool.apply(self._write, (table, payload)))
+            except Exception:
+                write_errors.inc()
+                dropped.inc(count)
+                log.exception('writing the recording of %s failed', table)
+                continue
+            recorded.inc(count)
+
+    def _run_flusher(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            for table in list(self._buffers):
+                self._flush(table)
+
+    def start(self):
+        metrics.greenlets.track(gevent.spawn(self._run_writer))
+        metrics.greenlets.track(gevent.spawn(self._run_flusher))
+
+#
+# Reading
+#
+def read_segment(f):
+    """
+    Yields (time, data) for each event in a segment file, a block at a time.
+    A block cut short, as the last one is if the server died while writing
+    it, ends the segment.
+    """
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise RecordingError('too short to be a recording')
+    magic, version = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise RecordingError('not a version {} recording'.format(VERSION))
+
+    while True:
+        head = f.read(BLOCK.size)
+        if len(head) < BLOCK.size:
+            return
+        size, raw_size = BLOCK.unpack(head)
+        block = f.read(size)
+        if len(block) < size:
+            return
+        payload = zlib.decompress(block)
+        if len(payload) != raw_size:
+            raise RecordingError('block is corrupt')
+
+        offset = 0
+        while offset < len(payload):
+            when, length = RECORD.unpack_from(payload, offset)
+            offset += RECORD.size
+            yield when, payload[offset:offset + length]
+            offset += length
+
+def segments(path):
+    """
+    Returns the segment files in a table's directory, oldest first, or just
+    `path` if it's a file.
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*' + SUFFIX)))
+    return [path]
+
+def read_recording(path, since=None, until=None):
+    """
+    Yields (time, data) for each event recorded at a table between `since`
+    and `until`, reading one segment at a time.
+    """
+    for name in segments(path):
+        with open(name, 'rb') as f:
+            for when, data in read_segment(f):
+                if since is not None and when < since:
+                    continue
+                if until is not None and when > until:
+                    return
+                yield when, data
+
+def to_json(data):
+    """
+    Returns an event as a dict, with binary strokes decoded into a DRAWN.
+    """
+    if strokes.is_strokes(data):
+        return {'verb': 'DRAWN', 'strokes': strokes.decode(data)}
+    return json.loads(data)
+
+def replay(events, speed=1.0, max_gap=5.0):
+    """
+    Yields each (time, data) from `events` when it's due, `speed` times as
+    fast as it was recorded. Pauses longer than `max_gap` seconds of
+    recording are cut short. A speed of 0 never waits.
+    """
+    last = None
+    due = time.time()
+    for when, data in events:
+        if speed and last is not None:
+            due += min(when - last, max_gap) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        last = when
+        yield when, data
+
+def publish(events, table):
+    """
+    Sends each (time, data) from `events` to the named table, the way the
+    server would, for its spectators to watch. Recorded turns and guesses
+    would upset a game in progress, so this refuses to start if anybody is
+    playing at the table, and stops as soon as anybody sits down.
+    """
+    import redis
+    from transport import PubSubTransport, StreamTransport
+    client = redis.from_url(os.environ['REDISCLOUD_URL'])
+    if os.environ.get('TRANSPORT', 'pubsub') == 'streams':
+        maxlen = int(os.environ.get('STREAM_MAXLEN', 1000))
+        transport = StreamTransport(client, 'sketch', maxlen=maxlen)
+    else:
+        transport = PubSubTransport(client, 'sketch', shards=1)
+
+    topic = 'table.' + table
+    players = '.'.join(['table', table, 'players'])
+    for when, data in events:
+        if client.zcard(players):
+            sys.exit('{} has players, not replaying into it'.format(table))
+        transport.publish(topic, data)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Export or replay a recorded '
+                                                    'SketchWithUs table')
+    parser.add_argument('command', choices=('export', 'replay'),
+                        help='export writes every event at once; replay '
+                                'writes them as they happened')
+    parser.add_argument('path',
+                        help="a table's recording directory or one segment")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='how many times faster than real time to replay')
+    parser.add_argument('--max-gap', type=float, default=5.0,
+                        help='longest pause to replay, in recorded seconds')
+    parser.add_argument('--since', type=float,
+                        help='skip events before this UNIX time')
+    parser.add_argument('--until', type=float,
+                        help='stop at events after this UNIX time')
+    parser.add_argument('--publish', metavar='TABLE',
+                        help='replay into this table, at REDISCLOUD_URL over '
+                                'the configured TRANSPORT, for spectators to '
+                                'watch, instead of writing JSON. The table '
+                                'must have no players')
+    args = parser.parse_args()
+
+    events = read_recording(args.path, args.since, args.until)
+    if args.command == 'replay':
+        events = replay(events, args.speed, args.max_gap)
+
+    if args.publish:
+        publish(events, args.publish)
+        return
+
+    out = sys.stdout
+    for when, data in events:
+        out.write(json.dumps({'time': when, 'event': to_json(data)},
+                                separators=(',', ':')))
+        out.write('\n')
+        if args.command == 'replay':
+            out.flush()
+
+if __name__ == '__main__':
+    main()
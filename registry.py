@@ -0,0 +1,134 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bookkeeping for the tables followed by this instance and the players at them.
+
+Both registries hand out snapshots for iteration: an immutable copy, made at
+most once per change, so broadcasting to every player or visiting every table
+can't be upset by somebody joining or leaving part way through.
+"""
+from gevent.event import AsyncResult
+
+class PlayerRegistry(object):
+    """
+    The players at one table connected to this instance, indexed by the name
+    each joined under.
+    """
+    def __init__(self):
+        self._players = {}                      # player -> name joined under
+        self._names = {}                        # name -> players using it
+        self._snapshot = ()
+
+    def add(self, player):
+        if player in self._players:
+            return
+        self._players[player] = player.name
+        self._names[player.name] = self._names.get(player.name, 0) + 1
+        self._snapshot = None
+
+    def remove(self, player):
+        name = self._players.pop(player)
+        if self._names[name] > 1:
+            self._names[name] -= 1
+        else:
+            del self._names[name]
+        self._snapshot = None
+
+    def has_name(self, name):
+        return name in self._names
+
+    def snapshot(self):
+        """
+        Returns the players as a tuple that won't change.
+        """
+        if self._snapshot is None:
+            self._snapshot = tuple(self._players)
+        return self._snapshot
+
+    def __contains__(self, player):
+        return player in self._players
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self._players)
+
+class TableRegistry(object):
+    """
+    The tables followed by this instance, by name.
+
+    A table that isn't here yet is built by `create(name)` exactly once, no
+    matter how many greenlets ask for it while that's underway: the rest wait
+    for the first to finish, and get its table or its exception.
+    """
+    def __init__(self):
+        self._tables = {}
+        self._pending = {}                      # name -> AsyncResult
+        self._snapshot = ()
+
+    def get(self, name, create=None):
+        """
+        Returns the named table, building it with `create` if given and it
+        isn't here. Returns None if it isn't here and there's no `create`.
+        """
+        try:
+            return self._tables[name]
+        except KeyError:
+            pass
+
+        pending = self._pending.get(name)
+        if pending is not None:
+            return pending.get()
+        if create is None:
+            return None
+
+        pending = self._pending[name] = AsyncResult()
+        try:
+            table = create(name)
+        except Exception as e:
+            del self._pending[name]
+            pending.set_exception(e)
+            raise
+
+        self._tables[name] = table
+        self._snapshot = None
+        del self._pending[name]
+        pending.set(table)
+        return table
+
+    def remove(self, name, table):
+        """
+        Forgets the named table, if it is still `table`.
+        """
+        if self._tables.get(name) is table:
+            del self._tables[name]
+            self._snapshot = None
+
+    def items(self):
+        """
+        Returns (name, table) pairs as a tuple that won't change.
+        """
+        if self._snapshot is None:
+            self._snapshot = tuple(self._tables.items())
+        return self._snapshot
+
+    def __contains__(self, name):
+        return name in self._tables
+
+    def __len__(self):
+        return len(self._tables)
@@ -0,0 +1,148 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Fans broadcasts out to spectators.
+
+Players each have a queue and a greenlet writing it, which is more than a
+table with thousands of people watching can afford. Spectators instead share
+one relay per instance, and only get a writer of their own while something is
+queued for them directly. The relay takes each broadcast once, encodes it at
+most once per format, and writes it to every spectator's socket in turn from
+its own greenlet.
+"""
+import logging
+from collections import deque
+import gevent
+from gevent import Timeout
+from gevent.event import Event
+import messages
+import metrics
+import strokes
+
+log = logging.getLogger(__name__)
+
+queued = metrics.gauge('relay_queue_frames',
+                        'Broadcasts waiting to be relayed to spectators')
+relayed = metrics.counter('relay_frames_total', 'Broadcasts relayed')
+thinned = metrics.counter('relay_frames_thinned_total',
+                            'Stroke broadcasts dropped while behind')
+evicted = metrics.counter('relay_spectators_evicted_total',
+                            'Spectators disconnected for blocking the relay')
+
+class Relay(object):
+    """
+    Writes broadcasts to spectators from a single greenlet.
+
+    Once `backlog` broadcasts are waiting, stroke broadcasts are thinned: only
+    one in every 1 + waiting / `backlog` is relayed, until the relay catches
+    up. Everything else is always relayed. A spectator whose socket takes more
+    than `timeout` seconds to accept a frame is disconnected.
+    """
+    def __init__(self, backlog=100, timeout=5):
+        self.backlog = backlog
+        self.timeout = timeout
+        self._queue = deque()               # (spectators, frame, text, lines)
+        self._wake = Event()
+        self._strokes_seen = 0
+
+    def send(self, spectators, data):
+        """
+        Relays an encoded message to each of `spectators`.
+        """
+        self._put((spectators, None, data, None))
+
+    def send_strokes(self, spectators, frame=None, text=None, lines=None):
+        """
+        Relays strokes to each of `spectators` in the format they asked for.
+        Give the binary `frame`, or the `lines` and their `text` if known.
+        """
+        self._put((spectators, frame, text, lines))
+
+    def _put(self, item):
+        self._queue.append(item)
+        queued.inc()
+        self._wake.set()
+
+    def _thin(self):
+        """
+        Whether to drop the stroke broadcast about to be relayed.
+        """
+        waiting = len(self._queue)
+        if waiting < self.backlog:
+            return False
+        self._strokes_seen += 1
+        return self._strokes_seen % (1 + waiting // self.backlog) != 0
+
+    def _run(self):
+        queue = self._queue
+        timeout = Timeout(self.timeout)
+        while True:
+            if not queue:
+                self._wake.clear()
+                self._wake.wait()
+                continue
+
+            item = queue.popleft()
+            queued.dec()
+            try:
+                self._relay(timeout, *item)
+            except Exception:
+                log.exception('relaying to spectators failed')
+
+    def _relay(self, timeout, spectators, frame, text, lines):
+        stroke = frame is not None or lines is not None
+        if stroke and self._thin():
+            thinned.inc()
+            return
+
+        for spectator in spectators:
+            if not spectator.alive:
+                continue
+            if stroke and spectator.binary_strokes:
+                if frame is None:
+                    frame = strokes.encode(lines)
+                data, binary = frame, True
+            else:
+                if text is None:
+                    if lines is None:
+                        lines = strokes.decode(frame)
+                    text = messages.encode(_drawn(lines))
+                data, binary = text, False
+            self._write(timeout, spectator, data, binary, stroke)
+        relayed.inc()
+
+    def _write(self, timeout, spectator, data, binary, stroke):
+        timeout.start()
+        try:
+            spectator.send_now(data, binary=binary, stroke=stroke)
+        except Timeout as e:
+            if e is not timeout:
+                raise
+            log.warning('spectator %s blocked the relay, disconnecting',
+                        spectator.name)
+            evicted.inc()
+            gevent.spawn(spectator.disconnect)
+        finally:
+            timeout.cancel()
+
+    def start(self):
+        metrics.greenlets.track(gevent.spawn(self._run))
+
+def _drawn(lines):
+    if len(lines) == 1:
+        return messages.Drawn(points=lines[0])
+    return messages.Drawn(strokes=lines)
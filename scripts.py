@@ -0,0 +1,214 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reads the current artist, word and end time.
+#
+# KEYS: turns, word, end
+STATE = """
+local artist = redis.call('ZRANGE', KEYS[1], 0, 0)[1] or false
+return {artist, redis.call('GET', KEYS[2]), redis.call('GET', KEYS[3])}
+"""
+
+# Adds a player to a table, grants them a lease, and reads everything they
+# need to catch up.
+#
+# KEYS: players, turns, word, end, leases
+# ARGV: player name, now, end time to use if the clock hasn't started, their
+#       lease, when it runs out
+JOIN = """
+local others = redis.call('ZRANGE', KEYS[1], 0, -1)
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZADD', KEYS[1], 0, ARGV[1])
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+end
+redis.call('ZADD', KEYS[5], ARGV[5], ARGV[4])
+
+local artist = redis.call('ZRANGE', KEYS[2], 0, 0)[1] or false
+local word = false
+if artist == ARGV[1] then
+    word = redis.call('GET', KEYS[3])
+    redis.call('SETNX', KEYS[4], ARGV[3])
+end
+return {others, artist, word, redis.call('GET', KEYS[4])}
+"""
+
+# Takes a player out of a table's player list and skip votes, and drops their
+# lease. They stay in the turn list if they're drawing, since their turn still
+# has to be passed, which takes them out of it. Returns 1 if they're drawing.
+#
+# KEYS: players, turns, skip, leases
+# ARGV: player name, their lease
+DEPART = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('SREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[2])
+if redis.call('ZRANGE', KEYS[2], 0, 0)[1] == ARGV[1] then
+    return 1
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 0
+"""
+
+# Checks a guess against the word and scores it, as long as the artist hasn't
+# changed since the caller last looked.
+#
+# KEYS: turns, word, players
+# ARGV: expected artist, guesser, guess
+GUESS = """
+local artist = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+local word = redis.call('GET', KEYS[2])
+if artist ~= ARGV[1] or ARGV[2] == artist or not word then
+    return {0, word, false}
+end
+if string.lower(word) ~= string.lower(ARGV[3]) then
+    return {0, word, false}
+end
+return {1, word, redis.call('ZINCRBY', KEYS[3], 1, ARGV[2])}
+"""
+
+# Counts the skip votes for the current artist.
+#
+# KEYS: turns, skip, players
+# ARGV: expected artist
+SKIP = """
+local artist = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+if artist ~= ARGV[1] then
+    return 0
+end
+local voted = redis.call('SCARD', KEYS[2])
+local total = redis.call('ZCARD', KEYS[3]) - 1
+if voted * 2 > total then
+    return 1
+end
+return 0
+"""
+
+# Passes the turn from the given artist to the next player in line, with the
+# next word off the deck, and starts a fresh canvas headed by the new end
+# time. An artist who is no longer one of the players leaves the turn list
+# instead of going to the back of it. Returns the new artist, the word and how
+# many words are left in the deck; nil if the given artist wasn't drawing; or
+# 0, changing nothing, if the deck is empty.
+#
+# KEYS: turns, word, skip, end, players, canvas, deck
+# ARGV: artist, new end time, now, "1" to reset scores
+PASS = """
+local artist = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+if artist ~= ARGV[1] then
+    return false
+end
+local word = redis.call('LPOP', KEYS[7])
+if not word then
+    return 0
+end
+local nxt = redis.call('ZRANGE', KEYS[1], 1, 1)[1] or artist
+
+redis.call('SET', KEYS[2], word)
+redis.call('DEL', KEYS[3])
+redis.call('SET', KEYS[4], ARGV[2])
+redis.call('DEL', KEYS[6])
+redis.call('RPUSH', KEYS[6], ARGV[2])
+
+if ARGV[4] == '1' then
+    for _, player in ipairs(redis.call('ZRANGE', KEYS[5], 0, -1)) do
+        redis.call('ZADD', KEYS[5], 0, player)
+    end
+end
+
+if redis.call('ZSCORE', KEYS[5], artist) then
+    redis.call('ZADD', KEYS[1], ARGV[3], artist)
+else
+    redis.call('ZREM', KEYS[1], artist)
+end
+return {nxt, word, redis.call('LLEN', KEYS[7])}
+"""
+
+# Adds words to the bottom of a table's deck, leaving out any that have
+# already been dealt. Returns how many words are in the deck.
+#
+# KEYS: deck, words dealt so far
+# ARGV: words
+DEAL = """
+for _, word in ipairs(ARGV) do
+    if redis.call('SADD', KEYS[2], word) == 1 then
+        redis.call('RPUSH', KEYS[1], word)
+    end
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# Stops the clock if the given artist is still drawing and their time is up.
+#
+# KEYS: turns, end
+# ARGV: expected artist, now
+END = """
+local artist = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+local end_time = tonumber(redis.call('GET', KEYS[2]))
+if artist ~= ARGV[1] or not end_time or end_time > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+return 1
+"""
+
+# Takes up to ARGV[2] players whose leases ran out before ARGV[1] out of their
+# tables' player lists, skip votes and turn lists, and drops their leases.
+# A player who is drawing stays in the turn list so their turn can be passed,
+# which takes them out of it. Returns {table, player, 1 if drawing else 0}
+# for each.
+#
+# Leases are JSON [table, player] pairs. The table keys are built here from
+# the table name, so this can't run against a Redis Cluster.
+#
+# KEYS: leases
+# ARGV: now, most to sweep
+SWEEP = """
+local swept = {}
+local leases = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                            'LIMIT', 0, ARGV[2])
+for _, lease in ipairs(leases) do
+    local pair = cjson.decode(lease)
+    local name, player = pair[1], pair[2]
+    local prefix = 'table.' .. name .. '.'
+    local drawing = 0
+    if redis.call('ZRANGE', prefix .. 'turns', 0, 0)[1] == player then
+        drawing = 1
+    else
+        redis.call('ZREM', prefix .. 'turns', player)
+    end
+    redis.call('ZREM', prefix .. 'players', player)
+    redis.call('SREM', prefix .. 'skip', player)
+    redis.call('ZREM', KEYS[1], lease)
+    table.insert(swept, {name, player, drawing})
+end
+return swept
+"""
+
+class TableScripts(object):
+    """
+    The Lua scripts used to read and change a table's game state, registered
+    with a particular Redis connection.
+    """
+    def __init__(self, client):
+        self.state = client.register_script(STATE)
+        self.join = client.register_script(JOIN)
+        self.depart = client.register_script(DEPART)
+        self.guess = client.register_script(GUESS)
+        self.skip = client.register_script(SKIP)
+        self.pass_turn = client.register_script(PASS)
+        self.deal = client.register_script(DEAL)
+        self.end = client.register_script(END)
@@ -19,180 +19,421 @@ import logging
 import redis
 import gevent
 import time
-import json
-from flask import Flask, render_template
+import socket
+from collections import deque
+from gevent.event import Event
+from gevent.lock import Semaphore
+from flask import Flask, Response, abort, render_template, request
 from flask_sockets import Sockets
 from werkzeug.datastructures import MultiDict
-from models import db, Word
-from peewee import *
+from wordpool import WordPool
+from wordstats import WordStats
+from scripts import TableScripts
+from messages import MessageError, decode, encode
+import messages
+import strokes
+from timers import TimerWheel
+from transport import PubSubTransport, StreamTransport
+from cluster import Cluster
+from presence import Presence, LEASES_KEY, lease
+from registry import PlayerRegistry, TableRegistry
+from relay import Relay
+from recorder import Recorder
+import metrics
+from profiler import Sampler
 
 REDIS_URL = os.environ['REDISCLOUD_URL']
 REDIS_CHAN = 'sketch'
 
+# How table events travel between instances: 'pubsub', or 'streams' to keep
+# a capped stream of STREAM_MAXLEN events per table that instances read
+# STREAM_BATCH at a time. An instance more than STREAM_SKIP_LAG seconds behind
+# skips strokes to catch up. Either way, channels are spread over
+# PUBSUB_SHARDS connections.
+TRANSPORT = os.environ.get('TRANSPORT', 'pubsub')
+PUBSUB_SHARDS = int(os.environ.get('PUBSUB_SHARDS', 4))
+STREAM_MAXLEN = int(os.environ.get('STREAM_MAXLEN', 1000))
+STREAM_BATCH = int(os.environ.get('STREAM_BATCH', 100))
+STREAM_SKIP_LAG = float(os.environ.get('STREAM_SKIP_LAG', 2))
+
+# In cluster mode each table is run by one owner instance, picked from a
+# consistent-hash ring of instances that heartbeat every CLUSTER_HEARTBEAT
+# seconds and drop out after CLUSTER_TTL seconds of silence.
+CLUSTER = 'CLUSTER' in os.environ
+NODE_ID = os.environ.get('NODE_ID',
+                            '{}:{}'.format(socket.gethostname(), os.getpid()))
+CLUSTER_HEARTBEAT = float(os.environ.get('CLUSTER_HEARTBEAT', 5))
+CLUSTER_TTL = float(os.environ.get('CLUSTER_TTL', 15))
+
+# Players hold a lease on their place at a table for PRESENCE_TTL seconds,
+# renewed every PRESENCE_INTERVAL seconds by the instance they're connected to.
+# If that instance dies, any instance sweeps them out once the lease runs out.
+PRESENCE_TTL = float(os.environ.get('PRESENCE_TTL', 30))
+PRESENCE_INTERVAL = float(os.environ.get('PRESENCE_INTERVAL', 10))
+
+# How long a table trusts its cached game state without hearing about it
+STATE_TTL = float(os.environ.get('STATE_TTL', 5))
+
+# Strokes arriving within STROKE_WINDOW seconds are published together, and
+# each artist may send STROKE_RATE points per second (STROKE_BURST at once).
+STROKE_WINDOW = float(os.environ.get('STROKE_WINDOW', 0.05))
+STROKE_RATE = float(os.environ.get('STROKE_RATE', 500))
+STROKE_BURST = float(os.environ.get('STROKE_BURST', 1000))
+
+# Word list snapshot written by `words.py --export`. If set, words are read
+# from it instead of the database.
+WORD_SNAPSHOT = os.environ.get('WORD_SNAPSHOT')
+
+# Words dealt into each table's deck at a time, and how few can be left
+# before more are dealt.
+DECK_SIZE = int(os.environ.get('DECK_SIZE', 50))
+DECK_LOW = int(os.environ.get('DECK_LOW', 10))
+
+# Most stroke frames kept per turn for players who join part way through.
+# Once a turn's canvas is full, later strokes are broadcast but not kept, so
+# late joiners see the start of the drawing. Trimming the other end instead
+# would drop the end time heading the list, which tables use to tell turns
+# apart, and shift the offsets their local copies are read from.
+CANVAS_MAX = int(os.environ.get('CANVAS_MAX', 5000))
+
+# Seconds of silence before a keepalive is sent, and before a player who
+# hasn't sent anything is disconnected (0 to never disconnect).
+KEEPALIVE_INTERVAL = float(os.environ.get('KEEPALIVE_INTERVAL', 30))
+IDLE_TIMEOUT = float(os.environ.get('IDLE_TIMEOUT', 1800))
+
+# Frames queued for a player before stroke frames start being dropped, the
+# largest merged stroke frame, and how long a player's queue may stay full
+# before they're disconnected.
+SEND_QUEUE_MAX = int(os.environ.get('SEND_QUEUE_MAX', 256))
+SEND_COALESCE_BYTES = int(os.environ.get('SEND_COALESCE_BYTES', 16384))
+SLOW_CONSUMER_TIMEOUT = float(os.environ.get('SLOW_CONSUMER_TIMEOUT', 10))
+
+# Broadcasts waiting for the spectator relay before it starts thinning out
+# strokes, and how long a spectator's socket may block it before they're
+# disconnected.
+RELAY_BACKLOG = int(os.environ.get('RELAY_BACKLOG', 100))
+RELAY_WRITE_TIMEOUT = float(os.environ.get('RELAY_WRITE_TIMEOUT', 5))
+
+# Directory to record every table's events into, if set. Events are compressed
+# in blocks of RECORD_BLOCK_BYTES, partly filled blocks are written every
+# RECORD_FLUSH seconds, and each table starts a new segment file every
+# RECORD_SEGMENT_BYTES. In a cluster only a table's owner records it.
+RECORD_DIR = os.environ.get('RECORD_DIR')
+RECORD_BLOCK_BYTES = int(os.environ.get('RECORD_BLOCK_BYTES', 65536))
+RECORD_FLUSH = float(os.environ.get('RECORD_FLUSH', 1))
+RECORD_SEGMENT_BYTES = int(os.environ.get('RECORD_SEGMENT_BYTES', 64 << 20))
+
+# Set to serve /debug/profile, which samples the worker's stacks for a few
+# seconds and returns them for a flame graph.
+PROFILER = 'PROFILER' in os.environ
+
 # Flask
 app = Flask(__name__)
 app.debug = 'DEBUG' in os.environ
-app.debug = True
 
 # Logging
-app.logger.setLevel(logging.DEBUG)
+app.logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')))
 
 # Flask Sockets
 sockets = Sockets(app)
 
 # Redis
-redis = redis.from_url(REDIS_URL)
-
-db.connect()
-
-def get_next_word(used=None):
-    try:
-        # Fetch a random word that hasn't been used much
-        subquery = Word.select(fn.Avg(Word.plays))
-        result = (Word.select()
-                    .order_by(fn.Random())
-                    .where(Word.plays <= subquery))
-        if used:
-            result = result.where((Word.text << used) == False)
-        result = result[0]
-
-        # Update its play count
-        query = Word.update(plays=Word.plays + 1).where(Word.id == result.id)
-        query.execute()
-
-        return result
-    except:
-        db.rollback()
-        raise
-
-def word_won(word):
-    try:
-        query = Word.update(wins=Word.wins + 1).where(Word.text == word)
-        query.execute()
-    except:
-        db.rollback()
-        raise
-
-app.logger.debug('Hello, World!')
+redis_latency = metrics.histogram('redis_command_seconds',
+                                    'Time spent on Redis commands',
+                                    labels=('command',))
 
-class Message(object):
+def _instrument_redis(client):
     """
-    A message that was or will be sent over a WebSocket connection.
+    Times every command sent through `client`, and every pipeline.
     """
-    def __init__(self, verb, **kwargs):
-        if isinstance(verb, Message):
-            # Copy constructor - make a copy of the message.
-            for k in dir(verb):
-                if not k.startswith('_'):
-                    setattr(self, k, getattr(verb, k))
-        else:
-            # Regular constructor
-            self.verb = verb.upper()
-            for k, v in kwargs.items():
-                setattr(self, k, v)
-
-    def _for_json(self):
-        return dict((x, getattr(self, x)) for x in dir(self) if not x.startswith('_'))
-
-def message_from_json(d):
-    if 'verb' not in d:
-        return d
+    execute_command = client.execute_command
+    def timed_command(*args, **options):
+        with redis_latency.labels(args[0]).time():
+            return execute_command(*args, **options)
+    client.execute_command = timed_command
+
+    pipeline = client.pipeline
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        def timed_execute(*args, **kwargs):
+            with redis_latency.labels('PIPELINE').time():
+                return execute(*args, **kwargs)
+        pipe.execute = timed_execute
+        return pipe
+    client.pipeline = timed_pipeline
+    return client
+
+redis = _instrument_redis(redis.from_url(REDIS_URL))
+scripts = TableScripts(redis)
+
+# Table ownership, if running as a cluster
+if CLUSTER:
+    cluster = Cluster(redis, NODE_ID, interval=CLUSTER_HEARTBEAT,
+                        ttl=CLUSTER_TTL)
+else:
+    cluster = None
+
+# Leases on the players connected here
+presence = Presence(redis, ttl=PRESENCE_TTL, interval=PRESENCE_INTERVAL)
+
+# Spectators are all written to by one relay
+relay = Relay(backlog=RELAY_BACKLOG, timeout=RELAY_WRITE_TIMEOUT)
+
+# Table recordings, if enabled
+if RECORD_DIR:
+    recorder = Recorder(RECORD_DIR, block_size=RECORD_BLOCK_BYTES,
+                        segment_size=RECORD_SEGMENT_BYTES,
+                        flush_interval=RECORD_FLUSH)
+else:
+    recorder = None
+
+# Keepalives, idle disconnects and turn ends all run off one timer wheel
+scheduler = TimerWheel()
+
+# Words
+word_stats = WordStats()
+word_pool = WordPool(word_stats, snapshot=WORD_SNAPSHOT)
+
+def word_played(word):
+    word_pool.played(word)
 
-    x = Message(d['verb'])
-    for k, v in d.items():
-        if not k.startswith('_'):
-            setattr(x, k, v)
-    return x
-
-class MessageEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if not hasattr(obj, '_for_json'):
-            return super(json.JSONEncoder, self).default(obj)
-
-        return obj._for_json()
+def word_won(word):
+    word_pool.won(word)
 
-def json_dumps(*args, **kwargs):
-    kwargs['cls'] = MessageEncoder
-    return json.dumps(*args, **kwargs)
+app.logger.debug('Hello, World!')
 
-def json_loads(*args, **kwargs):
-    kwargs['object_hook'] = message_from_json
-    return json.loads(*args, **kwargs)
+send_queued = metrics.gauge('send_queue_frames',
+                            'Frames waiting to be sent to players')
+send_coalesced = metrics.counter('send_frames_coalesced_total',
+                                    'Stroke frames merged into a queued frame')
+send_dropped = metrics.counter('send_frames_dropped_total',
+                                'Stroke frames dropped from full send queues')
+slow_evicted = metrics.counter('slow_consumers_evicted_total',
+                                'Players disconnected for not keeping up')
+forwarded = metrics.counter('cluster_forwarded_total',
+                            'Messages sent on to the owner of a table')
+player_messages = metrics.counter('player_messages_total',
+                                    'Messages received from players',
+                                    labels=('verb',))
+player_latency = metrics.histogram('player_message_seconds',
+                                    'Time spent handling player messages',
+                                    labels=('verb',))
+table_events = metrics.counter('table_events_total',
+                                'Table events received from Redis',
+                                labels=('verb',))
+table_latency = metrics.histogram('table_event_seconds',
+                                    'Time spent handling table events',
+                                    labels=('verb',))
+players_connected = metrics.gauge('players_connected',
+                                    'Players with an open connection')
 
 class Player(object):
     """Represents a connection from a browser"""
     def __init__(self, manager, ws):
         self.manager = manager
         self.socket = ws
-        self.last_message = time.time()
+        self.last_message = time.time()         # Last sent to the player
+        self.last_received = time.time()        # Last heard from the player
         self.alive = True
         self.table = None
         self.name = None
-
-    def _keepalive(self):
+        self.binary_strokes = False             # Strokes as binary frames?
+        self.spectating = False                 # Only watching the table?
+        self._timer = None
+        self._outbox = deque()                  # (data, binary, stroke)
+        self._wake = Event()
+        self._sending = Semaphore()             # Held while writing a frame
+        self._full_since = None                 # When the outbox filled up
+        self._writer = None                     # Started by the first frame
+        players_connected.inc()
+
+    def _check_timers(self):
         """
-        Sends a keepalive message if 30 seconds has passed since the last time
-        this player was sent a message.
+        Sends a keepalive message if KEEPALIVE_INTERVAL seconds have passed
+        since the last time this player was sent a message, and disconnects the
+        player if they haven't said anything in IDLE_TIMEOUT seconds.
+        Spectators have nothing to say, so they're never idle. Runs on the
+        timer wheel.
         """
-        wait_for = 30                           # How long to sleep each loop
-        while self.alive:
-            gevent.sleep(wait_for)              # Wait until the next check
-            now = time.time()
-            delta = now - self.last_message
-            if delta > 30:                      # More than 30 seconds?
-                self._send_keepalive()          # Yes. Send a keepalive, and
-                wait_for = 30                   # Wait another 30 seconds.
-            else:
-                wait_for = 30 - delta           # Nope, keep waiting.
+        if not self.alive:
+            return
+
+        now = time.time()
+        idle_timeout = not self.spectating and IDLE_TIMEOUT
+        if idle_timeout and now - self.last_received > idle_timeout:
+            gevent.spawn(self.disconnect)
+            return
+
+        if now - self.last_message >= KEEPALIVE_INTERVAL:
+            self._send_keepalive()
+            deadline = now + KEEPALIVE_INTERVAL
+        else:
+            deadline = self.last_message + KEEPALIVE_INTERVAL
+
+        if idle_timeout:
+            deadline = min(deadline, self.last_received + idle_timeout)
+        self._timer = scheduler.call_at(deadline, self._check_timers)
 
     def _send_keepalive(self):
         """
         Sends a simple keepalive message to the player to make sure it's still
         there.
         """
-        msg = Message('KEEPALIVE')
-        try:
-            self.send(msg)
-        except:
-            pass                                # Send takes care of disconnect
+        self.send(messages.Keepalive())
 
     def disconnect(self):
         """
         Closes the WebSocket and marks the player as dead.
         """
+        if not self.alive:
+            return                              # Already disconnected
         self.alive = False
+        players_connected.dec()
+        if self._timer is not None:
+            self._timer.cancel()
+        send_queued.dec(len(self._outbox))
+        self._outbox.clear()
+        self._wake.set()                        # Let the writer finish
         self.socket.close()
         if self.table is not None:
             self.table.disconnect(self)
 
     def send(self, msg):
         """
-        Sends a message to the player.
+        Queues a message to be sent to the player.
         """
-        try:
-            self.socket.send(json_dumps(msg))
-            self.last_message = time.time()
-        except:
-            self.disconnect()
-            raise
+        self.send_frame(encode(msg))
 
-    def run(self):
-        self.last_message = time.time()
-        gevent.spawn(self._keepalive)
+    def send_frame(self, data, binary=False, stroke=False):
+        """
+        Queues an already encoded message to be sent to the player. Frames are
+        sent in the order they're queued.
+
+        Stroke frames may be merged into the stroke frame queued before them,
+        and are dropped, oldest first, once SEND_QUEUE_MAX frames are waiting.
+        Everything else is always sent. A player whose queue stays full for
+        SLOW_CONSUMER_TIMEOUT seconds is disconnected.
+        """
+        if not self.alive:
+            return
+
+        outbox = self._outbox
+        if stroke and binary and outbox:
+            last, last_binary, last_stroke = outbox[-1]
+            if last_stroke and last_binary \
+                    and len(last) + len(data) <= SEND_COALESCE_BYTES:
+                outbox[-1] = (strokes.join([last, data]), True, True)
+                send_coalesced.inc()
+                return
+
+        if len(outbox) >= SEND_QUEUE_MAX:
+            now = time.time()
+            if self._full_since is None:
+                self._full_since = now
+            elif now - self._full_since > SLOW_CONSUMER_TIMEOUT:
+                self._error('not keeping up, disconnecting')
+                slow_evicted.inc()
+                self._full_since = None
+                gevent.spawn(self.disconnect)
+                return
+
+            # Make room by throwing away the stalest strokes
+            for idx, entry in enumerate(outbox):
+                if entry[2]:
+                    del outbox[idx]
+                    send_queued.dec()
+                    send_dropped.inc()
+                    break
+            else:
+                if stroke:
+                    send_dropped.inc()
+                    return                      # Nothing older to drop
+
+        outbox.append((data, binary, stroke))
+        send_queued.inc()
+        if self._writer is None:
+            self._writer = metrics.greenlets.track(gevent.spawn(self._write))
+        self._wake.set()
+
+    def _write(self):
+        """
+        Sends queued frames to the player, one at a time. Spectators are
+        mostly written to by the relay, so their writer stops once the queue
+        is empty, and is started again by the next frame queued.
+        """
+        outbox = self._outbox
         while self.alive:
-            gevent.sleep()
+            if not outbox:
+                if self.spectating:
+                    break
+                self._wake.clear()
+                self._wake.wait()
+                continue
 
-            self._debug('Waiting for message')
+            data, binary, stroke = outbox.popleft()
+            send_queued.dec()
+            if len(outbox) < SEND_QUEUE_MAX:
+                self._full_since = None
             try:
-                msg = self.socket.receive()
-                self._debug('Got message: {0}', extra=[msg])
-            except:
+                with self._sending:
+                    self.socket.send(data, binary=binary)
+            except Exception:
                 self.disconnect()
-                msg = None
+                break
+            self.last_message = time.time()
+        self._writer = None
 
-            if msg:
-                self.last_message = time.time()
-                self._handle_message(msg)
+    def send_now(self, data, binary=False, stroke=False):
+        """
+        Writes an already encoded message to the player from the calling
+        greenlet, unless frames are queued ahead of it or another is being
+        written, in which case it's queued behind them instead.
+        """
+        if not self.alive:
+            return
+        if self._outbox or not self._sending.acquire(blocking=False):
+            self.send_frame(data, binary=binary, stroke=stroke)
+            return
+
+        try:
+            self.socket.send(data, binary=binary)
+        except Exception:
+            gevent.spawn(self.disconnect)
+        else:
+            self.last_message = time.time()
+        finally:
+            self._sending.release()
+
+    def run(self):
+        """
+        Receives messages from the browser until the connection closes, or
+        handling one of them fails.
+        """
+        self.last_message = time.time()
+        self._check_timers()
+        receive = self.socket.receive
+        try:
+            while self.alive:
+                try:
+                    msg = receive()
+                except Exception:
+                    break
+
+                if msg is None:                 # Connection closed
+                    break
+
+                self._debug('Got message: {!r}', extra=[msg])
+                self.last_received = time.time()
+                if isinstance(msg, bytearray):  # Binary frames are strokes
+                    self._handle_strokes(msg)
+                elif msg:
+                    self._handle_message(msg)
+        except Exception:
+            app.logger.exception('PLAYER ({}) - handling a message failed'
+                                    .format(self.name))
+        finally:
+            self.disconnect()
 
     def _debug(self, *args, **kwargs):
         return self._log(logging.DEBUG, *args, **kwargs)
@@ -201,77 +442,144 @@ class Player(object):
         return self._log(logging.ERROR, *args, **kwargs)
 
     def _log(self, level, msg, extra=[]):
+        if not app.logger.isEnabledFor(level):
+            return                              # Don't bother formatting
         fmt = 'PLAYER ({}) - {}'
         fmt = fmt.format(self.name, msg)
         if extra:
             fmt = fmt.format(*extra)
         app.logger.log(level, fmt)
 
+    def _handle_strokes(self, data):
+        player_messages.labels('STROKES').inc()
+        if self.table is None:
+            self._error('draw command with no table')
+        elif self.spectating:
+            self._error('draw command from a spectator')
+        else:
+            with player_latency.labels('STROKES').time():
+                self.table.draw_strokes(self, bytes(data))
+
     def _handle_message(self, msg):
-        msg = json_loads(msg)
-        if msg.verb == 'KEEPALIVE':
+        try:
+            msg = decode(msg)
+        except MessageError as e:
+            self._error('bad message: {}', extra=[e])
             return
-        elif msg.verb == 'CONNECT':
-            try:
-                self.name = msg.player_name
-            except AttributeError:
-                self._error('connect command missing player_name')
-        elif msg.verb == 'JOIN':
-            try:
-                self.manager.find_table(msg.table).join(self)
-            except AttributeError:
-                self._error('join command missing table')
-        elif msg.verb == 'LEAVE':
-            if self.table is None:
-                self._error('leave command with no table')
-            else:
-                self.table.leave(self)
-                self.table = None
-        elif msg.verb == 'PASS':
-            if self.table is None:
-                self._error('pass command with no table')
-            else:
-                self.table.pass_turn(self)
-        elif msg.verb == 'SKIP':
-            if self.table is None:
-                self._error('skip command with no table')
-            else:
-                self.table.skip_turn(self)
-        elif msg.verb == 'DRAW':
-            if self.table is None:
-                self._error('draw command with no table')
-            else:
-                self.table.draw(self, msg.points);
-        elif msg.verb == 'GUESS':
-            if self.table is None:
-                self._error('guess command with no table')
-            else:
-                self.table.guess(self, msg.word)
+
+        try:
+            handler, needs_table, playing = self._handlers[msg.verb]
+        except KeyError:
+            self._error('unexpected {} command', extra=[msg.verb])
+            return
+
+        player_messages.labels(msg.verb).inc()
+        if needs_table and self.table is None:
+            self._error('{} command with no table', extra=[msg.verb.lower()])
+        elif playing and self.spectating:
+            self._error('{} command from a spectator',
+                        extra=[msg.verb.lower()])
+        else:
+            with player_latency.labels(msg.verb).time():
+                handler(self, msg)
+
+    def _on_keepalive(self, msg):
+        pass
+
+    def _on_connect(self, msg):
+        self.name = msg.player_name
+        self.binary_strokes = bool(msg.binary_strokes)
+
+    def _on_join(self, msg):
+        if self.name is None:
+            self._error('join command before connect')
+        elif msg.spectate:
+            self.manager.find_table(msg.table).spectate(self)
+        else:
+            self.manager.find_table(msg.table).join(self)
+
+    def _on_leave(self, msg):
+        self.table.leave(self)
+        self.table = None
+
+    def _on_pass(self, msg):
+        self.table.pass_turn(self)
+
+    def _on_skip(self, msg):
+        self.table.skip_turn(self)
+
+    def _on_draw(self, msg):
+        self.table.draw(self, msg.points)
+
+    def _on_guess(self, msg):
+        self.table.guess(self, msg.word)
+
+    # verb -> (handler, whether the player has to be at a table, whether they
+    # have to be playing rather than spectating)
+    _handlers = {'KEEPALIVE': (_on_keepalive, False, False),
+                    'CONNECT': (_on_connect, False, False),
+                    'JOIN': (_on_join, False, False),
+                    'LEAVE': (_on_leave, True, False),
+                    'PASS': (_on_pass, True, True),
+                    'SKIP': (_on_skip, True, True),
+                    'DRAW': (_on_draw, True, True),
+                    'GUESS': (_on_guess, True, True)}
+
+state_hits = metrics.counter('table_state_cache_hits_total',
+                                'Game state reads answered from the local cache')
+state_misses = metrics.counter('table_state_cache_misses_total',
+                                'Game state reads that had to go to Redis')
 
 class Table(object):
     """A group of players"""
     def __init__(self, manager, name):
         self.name = name
-        self.players = list()
+        self.players = PlayerRegistry()
+        self.spectators = PlayerRegistry()
         self.manager = manager
-        self.pubsub = manager.pubsub
+        self.transport = manager.transport
         self.topic = 'table.' + name
         self.players_key = '.'.join(['table', self.name, 'players'])
         self.turns_key = '.'.join(['table', self.name, 'turns'])
         self.word_key = '.'.join(['table', self.name, 'word'])
         self.skip_key = '.'.join(['table', self.name, 'skip'])
         self.end_key = '.'.join(['table', self.name, 'end'])
+        self.canvas_key = '.'.join(['table', self.name, 'canvas'])
+        self.deck_key = '.'.join(['table', self.name, 'deck'])
+        self.dealt_key = '.'.join(['table', self.name, 'dealt'])
         self.alive = True
 
-        # Subscribe to table updates
-        kwargs = {self.topic: self._handle_message}
-        self.pubsub.subscribe(**kwargs)
+        # Local copy of (artist, word, end_time), kept current by the events
+        # coming through the table topic.
+        self._state = None
+        self._state_expires = 0
 
-        # Set the initial starting word
-        redis.setnx(self.word_key, get_next_word().text)
+        # Strokes waiting to be published
+        self._strokes = strokes.StrokeBatcher(self._publish_strokes,
+                                                window=STROKE_WINDOW,
+                                                rate=STROKE_RATE,
+                                                burst=STROKE_BURST)
 
-        # Start the game end loop
-        gevent.spawn(self._end_game)
+        # Local copy of this turn's entries in the canvas list
+        self._canvas = []
+
+        # When the current turn's timer will run out
+        self._end_timer = None
+
+        # Set the initial starting word, and make sure there are more to come
+        self._refilling = None
+        if redis.exists(self.word_key):
+            self._refill_deck_later()
+        else:
+            self._refill_deck()
+            word = redis.lpop(self.deck_key)
+            if word is not None and redis.setnx(self.word_key, word):
+                word_played(word)
+
+        # Subscribe to table updates, last so nothing is left subscribed if
+        # anything above fails
+        self.transport.subscribe(self.topic, self._handle_message,
+                                    skippable=strokes.is_strokes)
 
     def _debug(self, *args, **kwargs):
         return self._log(logging.DEBUG, *args, **kwargs)
@@ -280,6 +588,8 @@ class Table(object):
         return self._log(logging.ERROR, *args, **kwargs)
 
     def _log(self, level, msg, extra=[]):
+        if not app.logger.isEnabledFor(level):
+            return                              # Don't bother formatting
         fmt = 'TABLE ({}) - {}'
         fmt = fmt.format(self.name, msg)
         if extra:
@@ -295,7 +605,7 @@ class Table(object):
             self._error('artist submitted a guess')
             return
 
-        self.send(Message('GUESSED', player_name=player.name, word=guess))
+        self.send(messages.Guessed(player_name=player.name, word=guess))
 
     def draw(self, player, points):
         """
@@ -307,72 +617,222 @@ class Table(object):
             self._error('player drawing when not the artist')
             return
 
-        self.send(Message('DRAWN', points=points))
+        try:
+            frame = strokes.encode([points])
+        except (TypeError, ValueError, IndexError) as e:
+            self._error('bad points: {}', extra=[e])
+            return
+
+        self._strokes.add(player.name, frame)
+
+    def draw_strokes(self, player, data):
+        """
+        Draws strokes sent as a binary frame on the canvas. The frame is
+        checked and batched as-is.
+        """
+        artist_name = self._get_artist()
+
+        if player.name != artist_name:
+            self._error('player drawing when not the artist')
+            return
 
-    def _get_artist(self):
         try:
-            return redis.zrange(self.turns_key, 0, 0)[0]
-        except IndexError:
-            return None
+            self._strokes.add(player.name, data)
+        except ValueError as e:
+            self._error('bad stroke frame: {}', extra=[e])
+
+    def _get_artist(self):
+        return self._get_state()[0]
+
+    def _get_state(self):
+        """
+        Returns the current artist, word and end time, from the local cache if
+        possible and otherwise in one round-trip to Redis.
+        """
+        if self._state is not None and time.time() < self._state_expires:
+            state_hits.inc()
+            return self._state
+
+        state_misses.inc()
+        keys = [self.turns_key, self.word_key, self.end_key]
+        artist, word, end_time = scripts.state(keys=keys)
+        self._set_state(artist, word, end_time)
+        return self._state
+
+    def _set_state(self, artist, word, end_time):
+        self._state = (artist, word, end_time)
+        self._state_expires = time.time() + STATE_TTL
+        self._schedule_end(end_time)
+
+    def _schedule_end(self, end_time):
+        """
+        Arranges for the turn to be ended at end_time, replacing any earlier
+        arrangement.
+        """
+        if end_time is not None:
+            end_time = float(end_time)
+
+        timer = self._end_timer
+        if timer is not None:
+            if timer.active and timer.args == (end_time,):
+                return                          # Already scheduled
+            timer.cancel()
+            self._end_timer = None
+
+        if end_time is not None and self.alive:
+            self._end_timer = scheduler.call_at(end_time, self._on_end,
+                                                end_time)
+
+    def _on_end(self, end_time):
+        self._end_timer = None
+        gevent.spawn(self._terminate_game)
+
+    def _update_state(self, msg):
+        """
+        Keeps the cached game state in step with an event from the table
+        topic.
+        """
+        if msg.verb == 'PASSED':
+            self._strokes.clear()               # Too late for the old turn
+            self._canvas = []                   # Blank canvas for the new turn
+            self._schedule_end(msg.end_time)    # and a new clock
+        elif msg.verb == 'ENDED':
+            self._schedule_end(None)
+
+        if self._state is None:
+            return
+
+        artist, word, end_time = self._state
+        if msg.verb == 'PASSED':
+            self._state = None                  # New artist and word
+        elif msg.verb == 'JOINED':
+            if artist is None:
+                self._state = None              # First player gets the turn
+        elif msg.verb == 'DEPARTED':
+            if msg.player_name == artist:
+                self._state = None              # Artist left, turn will pass
+        elif msg.verb == 'ENDED':
+            self._state = (artist, word, None)  # Clock was stopped
 
     def _has_artist(self, artist=None):
         if artist is None:
             artist = self._get_artist()
-        return any(x.name == artist for x in self.players)
+        return self.players.has_name(artist)
+
+    def _in_charge(self, artist=None):
+        """
+        Whether this instance runs the game: the table's owner in a cluster,
+        otherwise whichever instance has the artist.
+        """
+        if cluster is None:
+            return self._has_artist(artist)
+        return cluster.owns(self.name)
 
     def join(self, player):
-        if player.table == self:
+        if player.table == self and not player.spectating:
             return                              # Already part of this table.
 
-        if player.table is not None:
+        if player.table == self:
+            self.spectators.remove(player)      # Spectator taking a seat
+            player.spectating = False
+        elif player.table is not None:
             player.table.leave(player)          # Player has to leave old table
 
-        msg = Message('JOINED')                 # Tell all the other players
+        msg = messages.Joined()                 # Tell all the other players
         msg.player_name = player.name           # that a new player has joined.
         self.send(msg)
 
         player.table = self                     # Register the new player with
-        self.players.append(player)             # this table.
+        self.players.add(player)                # this table.
 
-        # Get a list of all the other players on this table
-        others = redis.zrange(self.players_key, 0, -1)
-
-        # Check if the player exists (race condition I guess)
-        score = redis.zscore(self.players_key, player.name)
-        if score is None:
-            # Add new player to the player list
-            redis.zadd(self.players_key, player.name, 0)
-
-            # Add player to the turn list if he/she wasn't already there
-            redis.zadd(self.turns_key, player.name, time.time())
+        # Add the player to the player and turn lists if they weren't already
+        # there, and find out who else is here and whose turn it is.
+        others, current, word, end_time = self._join(player.name)
+        if word is not None:
+            self._set_state(current, word, end_time)
 
         # Prepare joined messages for all existing players
         msgs = []
         for other in others:
             if other == player.name:
                 continue
-            msg = Message('JOINED')
+            msg = messages.Joined()
             msg.player_name = other
             msgs.append(msg)
 
         # Prepare passed message to set correct turn
-        current = self._get_artist()
-        msg = Message('PASSED', player_name=current)
+        msg = messages.Passed(player_name=current)
         if player.name == current:
-            msg.word = redis.get(self.word_key)
-
-            end_time = time.time() + 120
-            if not redis.setnx(self.end_key, end_time):
-                # Clock's already started!
-                end_time = redis.get(self.end_key)
+            msg.word = word
         else:
-            end_time = redis.get(self.end_key)
             assert(end_time is not None)
-        msg.end_time = end_time
+        msg.end_time = float(end_time)
         msgs.append(msg)
 
-        # Send all the prepared messages
-        gevent.joinall([gevent.spawn(player.send, x) for x in msgs])
+        # Send all the prepared messages, in order, then catch the player up
+        # on what's been drawn so far
+        for x in msgs:
+            player.send(x)
+        self._send_canvas(player)
+
+    def spectate(self, player):
+        """
+        Adds a player who only watches. They aren't in the turn order and
+        don't count towards skips, and they're only sent strokes, turn passes
+        and wins, through the relay. A player sitting at the table gives up
+        their seat.
+        """
+        if player.table == self:
+            if player.spectating:
+                return                          # Already watching this table.
+            self.spectators.add(player)         # Watch first, so the table
+            self._depart(player, False)         # isn't closed when they stand.
+        elif player.table is not None:
+            player.table.leave(player)          # Player has to leave old table
+
+        player.table = self
+        player.spectating = True
+        self.spectators.add(player)
+
+        artist, word, end_time = self._get_state()
+        if artist is not None:
+            msg = messages.Passed(player_name=artist)
+            if end_time is not None:
+                msg.end_time = float(end_time)
+            player.send(msg)
+        self._send_canvas(player)
+
+    def _send_canvas(self, player):
+        """
+        Sends a player everything drawn so far this turn.
+        """
+        lines = self._canvas_snapshot()
+        if lines:
+            if player.binary_strokes:
+                player.send_frame(strokes.join(lines, strokes.SNAPSHOT),
+                                    binary=True)
+            else:
+                frame = strokes.join(lines)
+                player.send(messages.Canvas(strokes=strokes.decode(frame)))
+
+    def _canvas_snapshot(self):
+        """
+        Brings the local copy of the current turn's canvas up to date and
+        returns its stroke frames. Only entries added since the last call are
+        read from Redis.
+        """
+        pipe = redis.pipeline()
+        pipe.lindex(self.canvas_key, 0)
+        pipe.lrange(self.canvas_key, len(self._canvas), -1)
+        head, entries = pipe.execute()
+
+        if self._canvas and head != self._canvas[0]:
+            # The turn has passed since we last looked. Start over.
+            self._canvas = []
+            entries = redis.lrange(self.canvas_key, 0, -1)
+
+        self._canvas.extend(entries)
+        return [x for x in self._canvas if strokes.is_strokes(x)]
 
     def disconnect(self, player):
         """
@@ -404,169 +864,334 @@ class Table(object):
 
         # Add the player to the list of voted players
         if redis.sadd(self.skip_key, player.name):
-            self.send(Message('SKIPPED', player_name=player.name))
+            self.send(messages.Skipped(player_name=player.name))
 
     def pass_turn(self, player):
         """
         If the given player is the active player, pass the turn to the next in
         line.
         """
-        # Get the player's current rank
-        rank = redis.zrank(self.turns_key, player.name)
+        # The pass script checks that it is his/her turn
+        self._request_pass(player.name)
 
-        # Check if it is his/her turn
-        if rank == 0:
-            self._pass_turn(player.name)
-
-    def _pass_turn(self, player_name, guesser=None, score=None):
-        # Get the next player
-        next_player = redis.zrange(self.turns_key, 1, 1)
-
-        # Are we playing with ourself?
-        if next_player:
-            next_player = next_player[0]
+    def _request_pass(self, player_name):
+        """
+        Passes the turn from player_name, or asks the table's owner to.
+        """
+        if cluster is None or cluster.owns(self.name):
+            self._pass_turn(player_name)
         else:
-            next_player = player_name
+            msg = messages.Yield(table=self.name, player_name=player_name)
+            self.manager.send_to_owner(self.name, msg)
 
-        # Set the new word
-        word = redis.set(self.word_key, get_next_word().text)
+    def _pass_turn(self, player_name, guesser=None, score=None):
+        """
+        Passes the turn from player_name to the next in line, unless someone
+        else got there first.
+        """
+        # Get the old artist's last strokes out before the canvas is cleared
+        self._strokes.flush()
 
-        # Clear the skip key
-        redis.delete(self.skip_key)
+        # Ten points to win the game
+        won = score is not None and score >= 10
+
+        # Set the new word, clear the skips, restart the clock, reset the
+        # scores if somebody won, and move the old player to the end of the
+        # turn list.
+        now = time.time()
+        end_time = now + 120
+        keys = [self.turns_key, self.word_key, self.skip_key, self.end_key,
+                self.players_key, self.canvas_key, self.deck_key]
+        args = [player_name, end_time, now, int(won)]
+        result = scripts.pass_turn(keys=keys, args=args)
+        if result == 0:
+            self._refill_deck()                 # Ran out of words
+            result = scripts.pass_turn(keys=keys, args=args)
+            if result == 0:
+                self._error('no words left to deal')
+                return
+        if result is None:
+            return                              # Not their turn anymore
+
+        next_player, word, left = result
+        word_played(word)
+        if left < DECK_LOW:
+            self._refill_deck_later()
 
         # Tell everyone who's turn it is
-        msg = Message('PASSED', player_name=next_player)
-        msg.end_time = time.time() + 120
-        redis.set(self.end_key, msg.end_time)
+        msg = messages.Passed(player_name=next_player)
+        msg.end_time = end_time
         if score is not None:
             msg.guesser = guesser
             msg.score = score
         self.send(msg)
 
-        # Ten points to win the game
-        if score >= 10:
+        if won:
             # Send the won message
-            self.send(Message('WON', player_name=guesser))
+            self.send(messages.Won(player_name=guesser))
+
+    def _refill_deck(self):
+        """
+        Tops the deck of upcoming words back up to DECK_SIZE. Words already
+        dealt at this table are never dealt again, until every word has been
+        and it starts over.
+        """
+        pipe = redis.pipeline()
+        pipe.llen(self.deck_key)
+        pipe.smembers(self.dealt_key)
+        left, dealt = pipe.execute()
+        wanted = DECK_SIZE - left
+        if wanted <= 0:
+            return
 
-            # Clear all scores
-            players = redis.zrange(self.players_key, 0, -1)
-            scores = dict((x, 0) for x in players)
-            redis.zadd(self.players_key, **scores)
+        dealt = set(x.decode('utf-8') for x in dealt)
+        words = word_pool.deal(wanted, dealt)
+        if not words and not left:
+            self._debug('every word has been dealt, starting over')
+            redis.delete(self.dealt_key)
+            words = word_pool.deal(wanted)
+        if words:
+            scripts.deal(keys=[self.deck_key, self.dealt_key], args=words)
 
-        # Move the old player to the end of the turn list
-        redis.zadd(self.turns_key, player_name, time.time())
+    def _refill_deck_later(self):
+        if self._refilling is None or self._refilling.ready():
+            self._refilling = gevent.spawn(self._refill_deck)
 
     def send(self, msg):
         """
         Sends a message to all players connected to this table.
         """
-        self._debug("PUBLISH - {}: {}", extra=[self.topic, json_dumps(msg)])
-        redis.publish(self.topic, json_dumps(msg))
+        self._publish(encode(msg))
+
+    def _publish_strokes(self, frame):
+        """
+        Publishes a stroke frame and adds it to the canvas for late joiners,
+        unless the canvas already holds CANVAS_MAX entries.
+        """
+        pipe = redis.pipeline()
+        pipe.rpush(self.canvas_key, frame)
+        pipe.ltrim(self.canvas_key, 0, CANVAS_MAX - 1)
+        self.transport.publish(self.topic, frame, pipe)
+        pipe.execute()
+
+    def _publish(self, data):
+        self._debug("PUBLISH - {}: {!r}", extra=[self.topic, data])
+        self.transport.publish(self.topic, data)
 
     def _depart(self, player, disconnected):
         """
         Removes a player from the table and updates all the other players.
         """
+        if player.spectating:
+            self.spectators.remove(player)      # Nobody else needs to know
+            player.spectating = False
+            self._close_if_unused()
+            return
+
         self.players.remove(player)
 
-        msg = Message('DEPARTED')               # Let everyone know
+        msg = messages.Departed()               # Let everyone know
         msg.player_name = player.name           # which player is leaving,
         msg.disconnected = disconnected         # and if they disconnected.
         self.send(msg)
 
-        # The only time DEPART causes a turn to shift is when the current
-        # artist leaves. The instance that receives the DEPART will always have
-        # the departing player. Therefore it is safe to do the _pass_turn call
-        # here.
-        artist = self._get_artist()
-        if player.name == artist:
-            self._pass_turn(player.name)
+        # Remove the player from the player and turn lists, and give up their
+        # lease. An artist stays first in the turn list until their turn is
+        # passed, here or by the table's owner, so the pass still finds them.
+        keys = [self.players_key, self.turns_key, self.skip_key, LEASES_KEY]
+        args = [player.name, lease(self.name, player.name)]
+        if scripts.depart(keys=keys, args=args):
+            self._request_pass(player.name)
 
-        # Remove player from the player and turn lists
-        redis.zrem(self.players_key, player.name)
-        redis.zrem(self.turns_key, player.name)
+        self._close_if_unused()
 
-        if not self.players:
-            self.pubsub.unsubscribe(self.topic) # No players? Unsubscribe from
-                                                # further updates.
-            self.manager.remove_table(self.name)
-            self.alive = False
+    def empty(self):
+        """
+        Whether nobody here is playing or watching.
+        """
+        return not self.players and not self.spectators
 
-    def _end_game(self):
-        while self.alive:
-            try:
-                end_time = float(redis.get(self.end_key))
-            except TypeError:
-                gevent.sleep(1)
-                continue
+    def seated(self, player_name):
+        """
+        Whether a player by that name is connected here and sitting at the
+        table.
+        """
+        return any(p.alive and p.name == player_name for p in self.players)
 
-            now = time.time()
-            if end_time < now:
-                self._terminate_game()
-            else:
-                gevent.sleep((end_time-now)/2)
+    def _close_if_unused(self):
+        """
+        Unsubscribes from further updates if nobody here is left, unless this
+        is the owner and players elsewhere still need it.
+        """
+        if self.empty() and (cluster is None or not cluster.owns(self.name)):
+            self.close()
+
+    def restore(self, player_name):
+        """
+        Puts a player who is still here back in the player and turn lists,
+        after their lease ran out without this instance renewing it.
+        """
+        self._join(player_name)
+        self.send(messages.Joined(player_name=player_name))
+
+    def _join(self, player_name):
+        """
+        Runs the JOIN script for a player, which also grants their lease, so
+        they can't be in the player list without one.
+        """
+        now = time.time()
+        keys = [self.players_key, self.turns_key, self.word_key, self.end_key,
+                LEASES_KEY]
+        args = [player_name, now, now + 120, lease(self.name, player_name),
+                presence.expiry()]
+        return scripts.join(keys=keys, args=args)
+
+    def close(self):
+        """
+        Stops following the table. Only called once it has no local players.
+        """
+        self._strokes.clear()
+        self._schedule_end(None)
+        self.transport.unsubscribe(self.topic)
+        if recorder is not None:
+            recorder.close(self.name)
+        self.manager.remove_table(self)
+        self.alive = False
 
     def _terminate_game(self):
-        if self._has_artist():
-            redis.delete(self.end_key)
-            self.send(Message('ENDED', player_name=self._get_artist()))
+        artist = self._get_artist()
+        if not self._in_charge(artist):
+            return
 
-    def _handle_message(self, msg):
+        # Only end the game if the clock hasn't been reset in the meantime
+        keys = [self.turns_key, self.end_key]
+        if scripts.end(keys=keys, args=[artist, time.time()]):
+            self.send(messages.Ended(player_name=artist))
+
+    def _handle_message(self, data):
         """
         Forwards messages from Redis to the players directly connected to this
-        instance.
+        instance, and records them. Runs on the table's own inbox greenlet.
+        """
+        start = time.time()
+        if recorder is not None and (cluster is None or
+                                        cluster.owns(self.name)):
+            recorder.record(self.name, data, start)
+        verb = self._handle_event(data)
+        if verb is not None:
+            table_events.labels(verb).inc()
+            table_latency.labels(verb).observe(time.time() - start)
+
+    def _handle_event(self, data):
         """
-        self._debug('RECEIVED - {}', extra=[str(msg)])
-        if msg['type'] != 'message' or msg['channel'] != self.topic:
-            return                              # Ignore messages we don't need
+        Does the work for _handle_message. Returns the verb handled.
+        """
+        self._debug('RECEIVED - {!r}', extra=[data])
+        if strokes.is_strokes(data):
+            self._broadcast_strokes(frame=data)
+            return 'DRAWN'
+
+        try:
+            msg = decode(data)
+        except MessageError as e:
+            self._error('bad message from Redis: {}', extra=[e])
+            return None
+
+        if msg.verb == 'DRAWN':
+            lines = msg.strokes or [msg.points]
+            try:
+                strokes.check(lines)
+            except ValueError as e:
+                self._error('bad strokes from Redis: {}', extra=[e])
+                return None
+            self._broadcast_strokes(text=data, lines=lines)
+            return msg.verb
 
-        msg = json_loads(msg['data'])
+        self._update_state(msg)
 
-        # If we have the artist, we're responsible for adjusting game state
+        # If we're in charge of the table, we're responsible for adjusting
+        # game state
         must_pass = False
-        artist = self._get_artist()
+        artist, word, end_time = self._get_state()
         score = None
         guesser = None
-        if self._has_artist(artist):
+        if self._in_charge(artist):
             if msg.verb == 'GUESSED':
                 if msg.player_name == artist:
                     self._error('artist ({}) submitted a guess', extra=[artist])
                 else:
-                    word = redis.get(self.word_key)
+                    # Check and score the guess in one go
+                    keys = [self.turns_key, self.word_key, self.players_key]
+                    args = [artist, msg.player_name, msg.word]
+                    correct, word, score = scripts.guess(keys=keys, args=args)
                     # TODO: Correct is only set for clients connected to this instance.
-                    msg.correct = word.lower() == msg.word.lower()
+                    msg.correct = bool(correct)
+                    data = None
                     if msg.correct:
                         guesser = msg.player_name
-                        score = redis.zincrby(self.players_key, msg.player_name, 1)
+                        score = int(float(score))
                         word_won(word)
                         must_pass = True
+                    else:
+                        score = None
             elif msg.verb == 'SKIPPED':
                 if msg.player_name == artist:
                     self._error('artist ({}) voted to skip', extra=[artist])
                 else:
-                    voted = redis.scard(self.skip_key)
-                    total = redis.zcard(self.players_key) - 1
-
-                    if voted * 2 > total:
-                        must_pass = True
+                    # Count the votes
+                    keys = [self.turns_key, self.skip_key, self.players_key]
+                    must_pass = bool(scripts.skip(keys=keys, args=[artist]))
             elif msg.verb == 'ENDED':
                 if msg.player_name == artist:
                     must_pass = True
                 # TODO: Player name will be sent on other instances
-                del msg.player_name
-
-        # Repeat the message to all players
+                msg.player_name = None
+                data = None
+
+        # Repeat the message to all players. Unless we changed it, the payload
+        # from Redis is passed through as-is, so each message is only encoded
+        # once no matter how many players there are.
+        if data is None:
+            data = encode(msg)
+        special = None
         for p in self.players:
             if msg.verb == 'PASSED' and msg.player_name == p.name:
                 # Add the word to the passed message for the correct player
-                special = Message(msg)
-                special.word = redis.get(self.word_key)
-                gevent.spawn(p.send, special)
+                if special is None:
+                    special = encode(msg.copy(word=word))
+                p.send_frame(special)
             else:
-                gevent.spawn(p.send, msg)
+                p.send_frame(data)
+        if self.spectators and msg.verb in ('PASSED', 'WON'):
+            relay.send(self.spectators.snapshot(), data)
 
         if must_pass:
             self._pass_turn(artist, guesser=guesser, score=score)
+        return msg.verb
+
+    def _broadcast_strokes(self, frame=None, text=None, lines=None):
+        """
+        Sends strokes to every local player in the format they asked for, and
+        hands them to the relay for spectators. Each format is encoded at most
+        once, and only if somebody wants it.
+        """
+        for p in self.players:
+            if p.binary_strokes:
+                if frame is None:
+                    frame = strokes.encode(lines)
+                p.send_frame(frame, binary=True, stroke=True)
+            else:
+                if text is None:
+                    if lines is None:
+                        lines = strokes.decode(frame)
+                    if len(lines) == 1:
+                        text = encode(messages.Drawn(points=lines[0]))
+                    else:
+                        text = encode(messages.Drawn(strokes=lines))
+                p.send_frame(text, stroke=True)
+        if self.spectators:
+            relay.send_strokes(self.spectators.snapshot(), frame=frame,
+                                text=text, lines=lines)
 
 class SketchBackend(object):
     """
@@ -574,38 +1199,171 @@ class SketchBackend(object):
     """
 
     def __init__(self):
-        self.tables = dict()
-        self.pubsub = redis.pubsub()
-        self.pubsub.subscribe(REDIS_CHAN)
+        self.tables = TableRegistry()
+        if TRANSPORT == 'streams':
+            self.transport = StreamTransport(redis, REDIS_CHAN,
+                                                shards=PUBSUB_SHARDS,
+                                                maxlen=STREAM_MAXLEN,
+                                                batch=STREAM_BATCH,
+                                                skip_lag=STREAM_SKIP_LAG)
+        else:
+            self.transport = PubSubTransport(redis, REDIS_CHAN,
+                                                shards=PUBSUB_SHARDS)
 
-    def __iter_messages(self):
-        for msg in self.pubsub.listen():
-            if msg['type'] == 'message':
-                yield msg['data']
+        if cluster is not None:
+            self.transport.subscribe(cluster.channel, self._handle_node_message)
+            cluster.on_heartbeat(self._rebalance)
 
     def find_table(self, name):
+        return self.tables.get(name, self._open_table)
+
+    def _open_table(self, name):
+        self._claim(name)                       # Before subscribing, so a
+        return Table(self, name)                # failed claim leaves nothing.
+
+    def remove_table(self, table):
+        self.tables.remove(table.name, table)
+
+    def send_to_owner(self, name, msg):
+        """
+        Sends a message to the instance that owns the named table.
+        """
+        channel = cluster.node_channel(cluster.owner(name))
+        self.transport.publish(channel, encode(msg))
+        forwarded.inc()
+
+    def _claim(self, name):
+        """
+        Makes sure the owner of the named table is following it.
+        """
+        if cluster is not None and not cluster.owns(name):
+            self.send_to_owner(name, messages.Claim(table=name))
+
+    def _handle_node_message(self, data):
+        """
+        Handles messages sent to this instance by the others in the cluster.
+        """
         try:
-            return self.tables[name]
-        except KeyError:
-            table = Table(self, name)
-            self.tables[name] = table
-            return table
+            msg = decode(data)
+        except MessageError as e:
+            app.logger.error('bad message from cluster: %s', e)
+            return
 
-    def remove_table(self, name):
-        del self.tables[name]
+        if msg.verb not in ('CLAIM', 'YIELD'):
+            app.logger.error('unexpected %s from cluster', msg.verb)
+            return
 
-    def run(self):
+        table = self.find_table(msg.table)
+        if msg.verb == 'YIELD':
+            table._pass_turn(msg.player_name)
+        else:
+            table._get_state()                  # Starts the turn's end timer
+
+    def _rebalance(self, changed):
+        """
+        Runs after each heartbeat. Tells new owners about tables with players
+        here if the ring changed, and lets go of tables nobody plays at
+        anymore or that now belong to somebody else.
+        """
+        for name, table in self.tables.items():
+            if not table.empty():
+                if changed:
+                    self._claim(name)
+            elif not cluster.owns(name) or not redis.zcard(table.players_key):
+                table.close()
+
+    def _leases(self):
+        """
+        Returns (table, player) for every player still connected to a table
+        here.
         """
-        Listens for new messages in Redis.
+        return [(name, p.name) for name, table in self.tables.items()
+                                for p in table.players if p.alive]
+
+    def _lease_expired(self, name, player_name, drawing):
+        """
+        Tells everyone at the named table that a player whose lease ran out
+        has gone, and passes the turn if it was theirs.
         """
-        for data in self.__iter_messages():
-            pass
+        msg = messages.Departed(player_name=player_name, disconnected=True)
+        self.transport.publish('table.' + name, encode(msg))
+        if not drawing:
+            return
+
+        if cluster is not None and not cluster.owns(name):
+            msg = messages.Yield(table=name, player_name=player_name)
+            self.send_to_owner(name, msg)
+            return
+
+        table = self.find_table(name)
+        table._pass_turn(player_name)
+        if table.empty() and cluster is None:
+            table.close()
+
+    def _lease_lapsed(self, name, player_name):
+        """
+        Puts a player whose lease was swept back at their table, as long as
+        they're still sitting at it. Otherwise they left while their lease
+        was being renewed, and renewing it put it back, so it's dropped.
+        """
+        table = self.tables.get(name)
+        if table is not None and table.seated(player_name):
+            table.restore(player_name)
+        else:
+            redis.zrem(LEASES_KEY, lease(name, player_name))
 
     def start(self):
-        gevent.spawn(self.run)
+        """
+        Starts listening for new messages in Redis, and renewing leases.
+        """
+        self.transport.start()
+        presence.start(self._leases, self._lease_expired, self._lease_lapsed)
 
 sketches = SketchBackend()
+if cluster is not None:
+    cluster.start()
 sketches.start()
+relay.start()
+if recorder is not None:
+    recorder.start()
+scheduler.start()
+word_stats.start()
+word_pool.start()
+
+metrics.gauge('tables', 'Tables followed by this worker',
+                function=lambda: len(sketches.tables))
+metrics.gauge('spectators', 'Spectators watching tables here',
+                function=lambda: sum(len(t.spectators)
+                                        for _, t in sketches.tables.items()))
+
+sampler = Sampler()
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profile')
+def profile():
+    """
+    Samples for ?seconds= (default 10, at most 60) and returns collapsed
+    stacks.
+    """
+    if not PROFILER:
+        abort(404)
+    if sampler.running:
+        abort(409)
+    seconds = 10
+    if 'seconds' in request.args:
+        seconds = request.args.get('seconds', type=float)
+        if seconds is None or not seconds > 0:
+            abort(400)
+    seconds = min(seconds, 60)
+    sampler.start()
+    try:
+        gevent.sleep(seconds)
+    finally:
+        sampler.stop()
+    return Response(sampler.collapsed(), mimetype='text/plain')
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
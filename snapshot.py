@@ -0,0 +1,140 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A compact, memory-mappable copy of the word list.
+
+A snapshot is a header followed by three arrays of little-endian uint32 and
+one blob of UTF-8 text:
+
+    magic, version, count, blob size
+    ids[count]              Word.id
+    plays[count]            play counts when the snapshot was taken
+    offsets[count + 1]      where each word starts in the blob
+    blob
+
+Words are sorted by their UTF-8 bytes, so they can be looked up by binary
+search without building an index. Workers that map the same file share one
+copy of it through the page cache.
+"""
+import mmap
+import os
+import struct
+from array import array
+
+MAGIC = b'SWUW'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+UINT = struct.Struct('<I')
+
+class SnapshotError(ValueError):
+    """Raised when a file isn't a snapshot this version can read"""
+
+def dump(rows, f):
+    """
+    Writes (id, text, plays) rows to the file `f` as a snapshot.
+    """
+    rows = sorted((text.encode('utf-8') if not isinstance(text, bytes)
+                    else text, word_id, plays)
+                    for word_id, text, plays in rows)
+    offsets = [0]
+    for text, _, _ in rows:
+        offsets.append(offsets[-1] + len(text))
+
+    count = len(rows)
+    f.write(HEADER.pack(MAGIC, VERSION, count, offsets[-1]))
+    f.write(struct.pack('<{}I'.format(count), *[r[1] for r in rows]))
+    f.write(struct.pack('<{}I'.format(count), *[r[2] for r in rows]))
+    f.write(struct.pack('<{}I'.format(count + 1), *offsets))
+    for text, _, _ in rows:
+        f.write(text)
+
+def export(rows, path):
+    """
+    Writes a snapshot to `path`, replacing any old one in a single step so
+    workers that have the old one mapped aren't disturbed.
+    """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        dump(rows, f)
+    os.rename(tmp, path)
+
+class WordSnapshot(object):
+    """
+    Read-only access to a snapshot held in a buffer, usually an mmap.
+    """
+    def __init__(self, buf):
+        if len(buf) < HEADER.size:
+            raise SnapshotError('too short to be a snapshot')
+        magic, version, count, size = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError('not a version {} snapshot'.format(VERSION))
+
+        self._buf = buf
+        self._count = count
+        self._ids = HEADER.size
+        self._plays = self._ids + 4 * count
+        self._offsets = self._plays + 4 * count
+        self._blob = self._offsets + 4 * (count + 1)
+        if len(buf) != self._blob + size:
+            raise SnapshotError('snapshot is truncated')
+
+    @classmethod
+    def empty(cls):
+        return cls(HEADER.pack(MAGIC, VERSION, 0, 0) + UINT.pack(0))
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self._count
+
+    def _bytes(self, idx):
+        start, end = struct.unpack_from('<II', self._buf,
+                                        self._offsets + 4 * idx)
+        return self._buf[self._blob + start:self._blob + end]
+
+    def text(self, idx):
+        return self._bytes(idx).decode('utf-8')
+
+    def word_id(self, idx):
+        return UINT.unpack_from(self._buf, self._ids + 4 * idx)[0]
+
+    def plays(self):
+        """
+        Returns a copy of the play counts that can be changed.
+        """
+        return array('l', struct.unpack_from('<{}I'.format(self._count),
+                                                self._buf, self._plays))
+
+    def find(self, word):
+        """
+        Returns the index of `word`, or None if it isn't in the snapshot.
+        """
+        if not isinstance(word, bytes):
+            word = word.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(mid) < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._bytes(lo) == word:
+            return lo
+        return None
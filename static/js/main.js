@@ -19,6 +19,70 @@
 (function(global) {
     'use strict';
 
+    /*
+     * Binary stroke frames: a 0x01 marker byte, then for each stroke a uint16
+     * point count, the first point as two int16s, and an int16 (dx, dy) pair
+     * for each following point. Everything is little-endian. Canvas snapshots
+     * sent on joining look the same but start with 0x02.
+     */
+    var STROKE_MARKER = 0x01,
+        SNAPSHOT_MARKER = 0x02;
+
+    var encodeStrokes = function encodeStrokes(strokes) {
+        var size = 1, ii, jj;
+        for (ii = 0; ii < strokes.length; ii++) {
+            size += 2 + 4 * strokes[ii].length;
+        }
+
+        var view = new DataView(new ArrayBuffer(size)),
+            offset = 1;
+        view.setUint8(0, STROKE_MARKER);
+        for (ii = 0; ii < strokes.length; ii++) {
+            var points = strokes[ii],
+                lastX = 0,
+                lastY = 0;
+            view.setUint16(offset, points.length, true);
+            offset += 2;
+            for (jj = 0; jj < points.length; jj++) {
+                var x = Math.round(points[jj][0]),
+                    y = Math.round(points[jj][1]);
+                view.setInt16(offset, x - lastX, true);
+                view.setInt16(offset + 2, y - lastY, true);
+                offset += 4;
+                lastX = x;
+                lastY = y;
+            }
+        }
+        return view.buffer;
+    };
+
+    var decodeStrokes = function decodeStrokes(buffer) {
+        var view = new DataView(buffer),
+            strokes = [],
+            offset = 1;
+        if (view.byteLength < 1) {
+            return strokes;
+        }
+        while (offset + 2 <= view.byteLength) {
+            var count = view.getUint16(offset, true),
+                points = [],
+                x = 0,
+                y = 0;
+            offset += 2;
+            if (offset + 4 * count > view.byteLength) {
+                break;
+            }
+            for (var ii = 0; ii < count; ii++) {
+                x += view.getInt16(offset, true);
+                y += view.getInt16(offset + 2, true);
+                offset += 4;
+                points.push([x, y]);
+            }
+            strokes.push(points);
+        }
+        return strokes;
+    };
+
     var DrawingArea = function DrawingArea(canvas) {
         this._canvas = canvas;
         this._ctx = canvas.getContext('2d');
@@ -356,6 +420,8 @@
         this._txt_guess = this._guess_form.find('.guess-input');
         this._timer = this._root.find('.time-remaining');
         this._myTurn = false;
+        this._binary = (typeof(DataView) !== 'undefined' &&
+                        typeof(ArrayBuffer) !== 'undefined');
 
         /* Set up skip/pass buttons */
         var that = this;
@@ -394,7 +460,11 @@
     };
 
     SketchTable.prototype._onstroke = function _onstroke(path) {
-        this._send({verb: 'DRAW', points: path});
+        if (this._binary) {
+            this._socket.send(encodeStrokes([path]));
+        } else {
+            this._send({verb: 'DRAW', points: path});
+        }
     };
 
     SketchTable.prototype._onpass = function _onpass(evt) {
@@ -439,11 +509,12 @@
         /* Restablish State */
         if (typeof(this._player_name) !== 'undefined') {
             this._chat.control('Registering as ' + this._player_name);
-            this._send({verb: 'CONNECT', player_name: this._player_name});
+            this._send({verb: 'CONNECT', player_name: this._player_name,
+                        binary_strokes: this._binary});
         }
 
         if (typeof(this._table) !== 'undefined') {
-            this.join(this._table);
+            this.join(this._table, this._spectate);
         }
     };
 
@@ -451,11 +522,38 @@
         var that = this;
         if (typeof(evt.data) === 'string') {
             this._processMessage(evt.data);
+        } else if (evt.data instanceof ArrayBuffer) {
+            this._processStrokes(evt.data);
         } else {
             var f = new FileReader();
             f.addEventListener('loadend',
-                function() { that._processMessage(f.result); });
-            f.readAsText(evt.data);
+                function() { that._processStrokes(f.result); });
+            f.readAsArrayBuffer(evt.data);
+        }
+    };
+
+    SketchTable.prototype._processStrokes = function _processStrokes(buffer) {
+        if (buffer.byteLength < 1) {
+            return;
+        }
+        var marker = new DataView(buffer).getUint8(0);
+        if (marker === STROKE_MARKER) {
+            this._drawStrokes(decodeStrokes(buffer), false);
+        } else if (marker === SNAPSHOT_MARKER) {
+            this._drawStrokes(decodeStrokes(buffer), true);
+        }
+    };
+
+    SketchTable.prototype._drawStrokes = function _drawStrokes(strokes,
+                                                                snapshot) {
+        /* The artist already has their own strokes, except after joining */
+        if (this._myTurn && !snapshot) {
+            return;
+        }
+        for (var ii = 0; ii < strokes.length; ii++) {
+            if (strokes[ii].length > 0) {
+                this._drawing.draw(strokes[ii]);
+            }
         }
     };
 
@@ -487,9 +585,10 @@
             this._skipped(obj.player_name);
             break;
         case 'DRAWN':
-            if (!this._myTurn) {
-                this._drawing.draw(obj.points);
-            }
+            this._drawStrokes(obj.strokes || [obj.points], false);
+            break;
+        case 'CANVAS':
+            this._drawStrokes(obj.strokes, true);
             break;
         case 'GUESSED':
             this._guessed(obj.player_name, obj.word, obj.correct);
@@ -517,6 +616,7 @@
         this._player_name = player_name;
 
         var ws = new ReconnectingWebSocket(this._url);
+        ws.binaryType = 'arraybuffer';
 
         var that = this;
         ws.onopen = function(evt) { that._onopen(evt); };
@@ -526,12 +626,19 @@
         this._socket = ws;
     };
 
-    SketchTable.prototype.join = function join(table) {
+    SketchTable.prototype.join = function join(table, spectate) {
         this._table = table;
+        this._spectate = !!spectate;
 
         if (this._socket.readyState === WebSocket.OPEN) {
-            this._chat.control('Joining table ' + table);
-            this._send({verb: 'JOIN', table: table});
+            var msg = {verb: 'JOIN', table: table};
+            if (this._spectate) {
+                this._chat.control('Watching table ' + table);
+                msg.spectate = true;
+            } else {
+                this._chat.control('Joining table ' + table);
+            }
+            this._send(msg);
 
             if (typeof(history.replaceState) !== 'undefined') {
                 history.replaceState(null, 'SketchWith.Us: ' + table,
@@ -632,7 +739,8 @@ $(function() {
     var $modal = $('#login-modal'),
         $btn = $('#login-button'),
         $name = $('#login-form-name'),
-        $table = $('#login-form-table');
+        $table = $('#login-form-table'),
+        $spectate = $('#login-form-spectate');
 
     var game = new SketchTable('.sketch-row');
 
@@ -679,7 +787,7 @@ $(function() {
 
         /* Perform the login and join */
         game.login(new_uri, name);
-        game.join(table);
+        game.join(table, $spectate.prop('checked'));
         return false;
     });
 
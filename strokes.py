@@ -0,0 +1,262 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compact binary encoding for strokes.
+
+A binary stroke frame is a single MARKER byte followed by one or more stroke
+records. A canvas snapshot is the same thing with a SNAPSHOT byte in front.
+Each record is a little-endian uint16 point count, the first point as two
+int16s, and then an int16 (dx, dy) pair for every following point.
+
+Frames can be checked, counted and concatenated by walking the record headers
+alone, so the server never has to look at individual points. StrokeBatcher
+relies on that to combine and rate limit incoming strokes cheaply.
+"""
+import struct
+import sys
+import time
+from array import array
+import gevent
+import metrics
+
+MARKER = b'\x01'
+SNAPSHOT = b'\x02'
+
+_HEADER = struct.Struct('<H')
+_INT16_MIN = -32768
+_INT16_MAX = 32767
+
+def _clamp(value):
+    return max(_INT16_MIN, min(_INT16_MAX, int(round(value))))
+
+def _point(point):
+    """
+    Returns an [x, y] point as clamped ints. Raises ValueError if it isn't a
+    pair of numbers.
+    """
+    try:
+        x, y = point
+        return _clamp(x), _clamp(y)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('bad point: {!r}'.format(point))
+
+def check(strokes):
+    """
+    Raises ValueError unless `strokes` is a list of strokes, each a list of
+    [x, y] points.
+    """
+    if not isinstance(strokes, list):
+        raise ValueError('bad strokes: {!r}'.format(strokes))
+    for points in strokes:
+        if not isinstance(points, list):
+            raise ValueError('bad stroke: {!r}'.format(points))
+        for point in points:
+            _point(point)
+
+def is_strokes(data):
+    """
+    True if a payload is a binary stroke frame rather than JSON.
+    """
+    return data[:1] == MARKER
+
+def encode(strokes):
+    """
+    Encodes a list of strokes, each a list of [x, y] points, as a frame.
+    Raises ValueError if any point isn't a pair of numbers.
+    """
+    parts = [MARKER]
+    for points in strokes:
+        if not points:
+            continue
+        n = min(len(points), 0xFFFF)
+        rec = array('h')
+        last_x, last_y = _point(points[0])
+        rec.append(last_x)
+        rec.append(last_y)
+        for point in points[1:n]:
+            x, y = _point(point)
+            dx = _clamp(x - last_x)
+            dy = _clamp(y - last_y)
+            rec.append(dx)
+            rec.append(dy)
+            last_x += dx
+            last_y += dy
+        if sys.byteorder != 'little':
+            rec.byteswap()
+        parts.append(_HEADER.pack(n))
+        parts.append(rec.tostring())
+    return b''.join(parts)
+
+def _records(data):
+    """
+    Yields (offset, count) for each stroke record in a frame, where offset is
+    where the record's points start. Raises ValueError on malformed frames.
+    """
+    if not is_strokes(data):
+        raise ValueError('not a stroke frame')
+    offset = 1
+    size = len(data)
+    while offset < size:
+        if offset + 2 > size:
+            raise ValueError('truncated stroke header')
+        (count,) = _HEADER.unpack_from(data, offset)
+        offset += 2
+        end = offset + 4 * count
+        if count == 0 or end > size:
+            raise ValueError('truncated stroke')
+        yield offset, count
+        offset = end
+
+def count_points(data):
+    """
+    Returns the number of points in a frame, checking its structure without
+    decoding any points. Raises ValueError on malformed frames.
+    """
+    return sum(count for _, count in _records(data))
+
+def count_strokes(data):
+    """
+    Returns the number of strokes in a frame. Raises ValueError on malformed
+    frames.
+    """
+    return sum(1 for _ in _records(data))
+
+def join(frames, marker=MARKER):
+    """
+    Combines several frames into one.
+    """
+    return marker + b''.join(bytes(f[1:]) for f in frames)
+
+def decode(data):
+    """
+    Decodes a frame into a list of strokes, each a list of [x, y] points.
+    """
+    data = bytes(data)
+    strokes = []
+    for offset, count in _records(data):
+        values = array('h')
+        values.fromstring(data[offset:offset + 4 * count])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        x = y = 0
+        points = []
+        for i in range(0, len(values), 2):
+            x += values[i]
+            y += values[i + 1]
+            points.append([x, y])
+        strokes.append(points)
+    return strokes
+
+batches = metrics.counter('stroke_batches_total',
+                            'Batched stroke frames published')
+merged = metrics.counter('strokes_merged_total',
+                            'Stroke frames merged into an existing batch')
+dropped = metrics.counter('strokes_dropped_total',
+                            'Stroke frames dropped by the rate limit')
+dropped_points = metrics.counter('stroke_points_dropped_total',
+                                    'Points dropped by the rate limit')
+
+class TokenBucket(object):
+    """
+    Allows `rate` units per second on average, with bursts of up to
+    `capacity`.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.time()
+
+    def take(self, amount):
+        """
+        Takes `amount` units if there are enough, returning whether it did.
+        """
+        now = time.time()
+        self.tokens = min(self.capacity,
+                            self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if amount > self.tokens:
+            return False
+        self.tokens -= amount
+        return True
+
+class StrokeBatcher(object):
+    """
+    Collects the stroke frames an artist sends within a short window and
+    publishes them together as one frame, dropping frames that go over the
+    artist's points-per-second limit.
+    """
+    def __init__(self, publish, window=0.05, rate=500, burst=1000):
+        self.publish = publish                  # Called with each batch
+        self.window = window                    # Seconds to collect for
+        self.rate = rate                        # Points per second allowed
+        self.burst = burst                      # Points allowed at once
+        self._frames = []
+        self._timer = None
+        self._artist = None
+        self._bucket = None
+
+    def add(self, artist, frame):
+        """
+        Queues a frame from the given artist. Returns False if it was dropped.
+        Raises ValueError if the frame is malformed.
+        """
+        points = count_points(frame)
+
+        if artist != self._artist:              # New artist, new allowance
+            self._artist = artist
+            self._bucket = TokenBucket(self.rate, self.burst)
+
+        if not self._bucket.take(points):
+            dropped.inc()
+            dropped_points.inc(points)
+            return False
+
+        self._frames.append(frame)
+        if self._timer is None:
+            self._timer = metrics.greenlets.track(
+                gevent.spawn_later(self.window, self.flush))
+        else:
+            merged.inc()
+        return True
+
+    def flush(self):
+        """
+        Publishes whatever has been collected so far.
+        """
+        if self._timer is not None:
+            if self._timer is not gevent.getcurrent():
+                self._timer.kill(block=False)
+            self._timer = None
+
+        frames, self._frames = self._frames, []
+        if not frames:
+            return
+        batches.inc()
+        if len(frames) == 1:
+            self.publish(frames[0])
+        else:
+            self.publish(join(frames))
+
+    def clear(self):
+        """
+        Throws away anything collected and stops the timer.
+        """
+        if self._timer is not None:
+            self._timer.kill(block=False)
+            self._timer = None
+        self._frames = []
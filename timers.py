@@ -0,0 +1,125 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import math
+import time
+import gevent
+import metrics
+
+log = logging.getLogger(__name__)
+
+pending = metrics.gauge('timers_pending', 'Timers waiting to fire')
+fired = metrics.counter('timers_fired_total', 'Timers that have fired')
+cancelled = metrics.counter('timers_cancelled_total',
+                            'Timers cancelled before firing')
+lateness = metrics.summary('timer_lateness_seconds',
+                            'How long after their deadline timers fired')
+
+class Timer(object):
+    """A callback waiting on a TimerWheel"""
+    __slots__ = ('deadline', 'tick', 'callback', 'args', 'active')
+
+    def __init__(self, deadline, tick, callback, args):
+        self.deadline = deadline
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def cancel(self):
+        if self.active:
+            self.active = False
+            pending.dec()
+            cancelled.inc()
+
+class TimerWheel(object):
+    """
+    Runs callbacks at given times from a single greenlet.
+
+    Timers are hashed into a ring of slots by the tick they fall due on, so
+    scheduling and cancelling are O(1) and each tick only looks at one slot.
+    Deadlines are rounded up to the next tick.
+
+    Callbacks run on the wheel's greenlet and must not block. Anything that
+    does I/O should spawn a greenlet of its own.
+    """
+    def __init__(self, tick=0.25, slots=1024):
+        self.tick = tick                        # Seconds per tick
+        self._slots = [[] for _ in range(slots)]
+        self._origin = time.time()
+        self._done = 0                          # Last tick processed
+
+    def call_at(self, deadline, callback, *args):
+        """
+        Calls `callback(*args)` at `deadline`. Returns a Timer that can be
+        cancelled.
+        """
+        tick = int(math.ceil((deadline - self._origin) / self.tick))
+        tick = max(tick, self._done + 1)
+        timer = Timer(deadline, tick, callback, args)
+        self._slots[tick % len(self._slots)].append(timer)
+        pending.inc()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """
+        Calls `callback(*args)` after `delay` seconds.
+        """
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def _advance(self, now):
+        """
+        Fires every timer due up to `now`.
+        """
+        target = int((now - self._origin) / self.tick)
+        while self._done < target:
+            self._done += 1
+            idx = self._done % len(self._slots)
+            slot = self._slots[idx]
+            if not slot:
+                continue
+
+            # Timers more than one lap away stay where they are.
+            due = []
+            later = []
+            for timer in slot:
+                if not timer.active:
+                    continue
+                if timer.tick <= self._done:
+                    due.append(timer)
+                else:
+                    later.append(timer)
+            self._slots[idx] = later
+
+            for timer in due:
+                timer.active = False
+                pending.dec()
+                fired.inc()
+                lateness.observe(max(0, now - timer.deadline))
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    log.exception('timer callback failed')
+
+    def run(self):
+        while True:
+            next_tick = self._origin + (self._done + 1) * self.tick
+            gevent.sleep(max(0, next_tick - time.time()))
+            self._advance(time.time())
+
+    def start(self):
+        metrics.greenlets.track(gevent.spawn(self.run))
@@ -0,0 +1,298 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Moves messages between instances over Redis.
+
+Every channel a process listens to gets an inbox and a worker greenlet of its
+own, so a table that is slow to handle its messages only holds up itself.
+
+Two transports are available. PubSubTransport uses pub/sub, which is cheap but
+forgets anything sent while an instance wasn't listening. StreamTransport
+keeps a capped stream per channel and reads it from where it left off.
+
+Either way, each message carries when it was published: pub/sub messages are
+prefixed with a timestamp, and stream entry IDs start with one. The time from
+then until the message is handled is the fan-out lag.
+"""
+import logging
+import struct
+import time
+import gevent
+from gevent.event import Event
+from gevent.queue import Queue
+from redis.exceptions import RedisError
+import metrics
+
+log = logging.getLogger(__name__)
+
+routed = metrics.counter('dispatch_messages_total',
+                            'Messages routed to an inbox')
+unrouted = metrics.counter('dispatch_unrouted_total',
+                            'Messages for channels nobody is listening to')
+queued = metrics.gauge('dispatch_inbox_messages',
+                        'Messages waiting in inboxes')
+handling = metrics.summary('dispatch_handler_seconds',
+                            'Time spent handling each message')
+waiting = metrics.histogram('dispatch_wait_seconds',
+                            'Time messages spent in an inbox before handling')
+lag = metrics.histogram('dispatch_lag_seconds',
+                        'Time from publishing a message to handling it')
+
+STAMP = struct.Struct('<d')
+
+_STOP = object()
+
+class Inbox(object):
+    """Messages for one channel, handled in order by their own greenlet"""
+    def __init__(self, channel, handler):
+        self.channel = channel
+        self.handler = handler
+        self._queue = Queue()
+        self._worker = metrics.greenlets.track(gevent.spawn(self._run))
+
+    def put(self, data, sent):
+        queued.inc()
+        self._queue.put((sent, time.time(), data))
+
+    def close(self):
+        self._queue.put(_STOP)
+
+    def _run(self):
+        for item in self._queue:
+            if item is _STOP:
+                break
+            queued.dec()
+            sent, received, data = item
+            now = time.time()
+            waiting.observe(now - received)
+            lag.observe(max(0, now - sent))
+            try:
+                with handling.time():
+                    self.handler(data)
+            except Exception:
+                log.exception('handler for %s failed', self.channel)
+
+        # Anything left over is never going to be handled
+        queued.dec(self._queue.qsize())
+
+class PubSubTransport(object):
+    """
+    Publishes to and listens on Redis pub/sub channels.
+
+    Channels are spread over `shards` pub/sub connections by hash, each read
+    by its own greenlet, and every message is handed to the inbox for its
+    channel. Every shard also listens on `control`, which keeps its
+    connection open while it has no other channels.
+    """
+    def __init__(self, client, control, shards=4):
+        self.client = client
+        self.control = control
+        self._shards = [client.pubsub() for _ in range(shards)]
+        self._inboxes = {}
+        for pubsub in self._shards:
+            pubsub.subscribe(control)
+
+    def _shard(self, channel):
+        return self._shards[hash(channel) % len(self._shards)]
+
+    def subscribe(self, channel, handler, skippable=None):
+        """
+        Calls `handler(data)` for each message published to `channel`.
+        `skippable` is ignored; pub/sub never falls behind.
+        """
+        if channel in self._inboxes:
+            raise ValueError('already subscribed to ' + channel)
+        self._inboxes[channel] = Inbox(channel, handler)
+        if channel != self.control:
+            self._shard(channel).subscribe(channel)
+
+    def unsubscribe(self, channel):
+        inbox = self._inboxes.pop(channel, None)
+        if inbox is None:
+            return
+        inbox.close()
+        if channel != self.control:
+            self._shard(channel).unsubscribe(channel)
+
+    def publish(self, channel, data, pipe=None):
+        """
+        Publishes `data` to `channel`, as part of `pipe` if given.
+        """
+        client = self.client if pipe is None else pipe
+        client.publish(channel, STAMP.pack(time.time()) + data)
+
+    def _listen(self, pubsub):
+        inboxes = self._inboxes
+        for msg in pubsub.listen():
+            if msg['type'] != 'message':
+                continue
+            inbox = inboxes.get(msg['channel'])
+            if inbox is None:
+                unrouted.inc()                  # Unsubscribed in the meantime
+                continue
+            data = msg['data']
+            if len(data) < STAMP.size:
+                log.error('unstamped message on %s', msg['channel'])
+                continue
+            routed.inc()
+            inbox.put(data[STAMP.size:], STAMP.unpack_from(data)[0])
+
+    def start(self):
+        for pubsub in self._shards:
+            metrics.greenlets.track(gevent.spawn(self._listen, pubsub))
+
+stream_reads = metrics.counter('stream_reads_total', 'XREAD calls made')
+stream_read_errors = metrics.counter('stream_read_errors_total',
+                                        'XREAD calls that failed')
+stream_entries = metrics.counter('stream_entries_read_total',
+                                    'Stream entries read')
+stream_skipped = metrics.counter('stream_entries_skipped_total',
+                                    'Skippable entries dropped while lagging')
+stream_lag = metrics.gauge('stream_lag_seconds',
+                            'Age of the newest entry in the last batch read')
+
+class StreamTransport(object):
+    """
+    Publishes to and listens on capped Redis streams, one per channel.
+
+    Each channel's stream is read with XREAD from the last entry this instance
+    saw, so a dropped connection picks up where it stopped instead of losing
+    messages. Channels are spread over `shards` reading greenlets, each of
+    which reads up to `batch` entries per stream at a time. Messages for a
+    newly subscribed channel are picked up within `block` seconds.
+
+    An instance is lagging when a read fills a whole batch, or when the entry
+    it just read is more than `skip_lag` seconds old. While lagging, entries
+    the subscriber marked as skippable are dropped so it can catch up on the
+    ones that matter.
+    """
+    def __init__(self, client, control, shards=4, maxlen=1000, batch=100,
+                    block=1.0, skip_lag=2.0):
+        self.client = client
+        self.control = control
+        self.maxlen = maxlen
+        self.batch = batch
+        self.block = block
+        self.skip_lag = skip_lag
+        self._inboxes = {}
+        self._skippable = {}
+        self._channels = {}                             # key -> channel
+        self._offsets = [{} for _ in range(shards)]     # key -> last id read
+        self._wakes = [Event() for _ in range(shards)]
+
+    def _key(self, channel):
+        return (channel + '.events').encode('utf-8')
+
+    def _shard(self, channel):
+        return hash(channel) % len(self._offsets)
+
+    def subscribe(self, channel, handler, skippable=None):
+        """
+        Calls `handler(data)` for each message published to `channel` from
+        now on. `skippable(data)` says whether a message can be dropped when
+        this instance falls behind.
+        """
+        if channel in self._inboxes:
+            raise ValueError('already subscribed to ' + channel)
+        key = self._key(channel)
+        last = self.client.execute_command('XREVRANGE', key, '+', '-',
+                                            'COUNT', 1)
+        self._inboxes[channel] = Inbox(channel, handler)
+        self._skippable[channel] = skippable
+        self._channels[key] = channel
+        shard = self._shard(channel)
+        self._offsets[shard][key] = last[0][0] if last else '0-0'
+        self._wakes[shard].set()
+
+    def unsubscribe(self, channel):
+        inbox = self._inboxes.pop(channel, None)
+        if inbox is None:
+            return
+        inbox.close()
+        key = self._key(channel)
+        del self._skippable[channel]
+        del self._channels[key]
+        del self._offsets[self._shard(channel)][key]
+
+    def publish(self, channel, data, pipe=None):
+        """
+        Appends `data` to the stream for `channel`, as part of `pipe` if
+        given. Old entries are trimmed to keep about `maxlen`.
+        """
+        client = self.client if pipe is None else pipe
+        client.execute_command('XADD', self._key(channel), 'MAXLEN', '~',
+                                self.maxlen, '*', 'd', data)
+
+    def _read(self, offsets):
+        keys = list(offsets)
+        stream_reads.inc()
+        return self.client.execute_command('XREAD', 'COUNT', self.batch,
+                                            'BLOCK', int(self.block * 1000),
+                                            'STREAMS', *(keys + [offsets[k]
+                                                            for k in keys]))
+
+    def _deliver(self, key, entries, now):
+        channel = self._channels[key]
+        inbox = self._inboxes[channel]
+
+        newest = _entry_time(entries[-1][0])
+        behind = max(0, now - newest)
+        stream_lag.set(behind)
+        skippable = self._skippable[channel]
+        lagging = skippable is not None and \
+                    (len(entries) >= self.batch or behind > self.skip_lag)
+
+        for entry_id, fields in entries:
+            data = fields[fields.index(b'd') + 1]
+            if lagging and skippable(data):
+                stream_skipped.inc()
+                continue
+            inbox.put(data, _entry_time(entry_id))
+        stream_entries.inc(len(entries))
+
+    def _listen(self, shard):
+        offsets = self._offsets[shard]
+        wake = self._wakes[shard]
+        while True:
+            if not offsets:
+                wake.clear()
+                wake.wait()
+                continue
+
+            try:
+                reply = self._read(offsets)
+            except RedisError:
+                stream_read_errors.inc()
+                log.exception('reading streams failed, retrying')
+                gevent.sleep(self.block)
+                continue
+
+            now = time.time()
+            for key, entries in reply or ():
+                if key in offsets and entries:
+                    offsets[key] = entries[-1][0]
+                    self._deliver(key, entries, now)
+
+    def start(self):
+        for shard in range(len(self._offsets)):
+            metrics.greenlets.track(gevent.spawn(self._listen, shard))
+
+def _entry_time(entry_id):
+    """
+    Returns when a stream entry was added, from the milliseconds in its ID.
+    """
+    return float(entry_id.split(b'-')[0]) / 1000
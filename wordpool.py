@@ -0,0 +1,210 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import os
+import random
+import time
+from array import array
+from io import BytesIO
+import gevent
+import metrics
+from models import db, Word
+from snapshot import WordSnapshot, dump
+
+log = logging.getLogger(__name__)
+
+class WordPool(object):
+    """
+    An in-memory copy of the word list.
+
+    The words themselves are held in a WordSnapshot, either mapped from the
+    `snapshot` file or built from the database, and bucketed by play count
+    so picking an under-played word doesn't need to sort the whole table.
+    Play and win counts are handed to a WordStats aggregator to be written
+    back later.
+    """
+    def __init__(self, stats, refresh=300, snapshot=None):
+        self.stats = stats
+        self.refresh_interval = refresh         # Seconds between reloads
+        self.snapshot = snapshot                # Snapshot file, if any
+        self.loaded_at = None
+
+        self._words = WordSnapshot.empty()      # index -> word and Word.id
+        self._mtime = None                      # Of the mapped snapshot
+        self._plays = array('l')                # index -> play count
+        self._buckets = {}                      # play count -> indices
+        self._slots = array('l')                # index -> position in bucket
+        self._total_plays = 0
+
+    def __len__(self):
+        return len(self._words)
+
+    def load(self):
+        """
+        Replaces the pool with a fresh copy of the word list, from the
+        snapshot file if there is one and it has changed, otherwise from the
+        database.
+        """
+        if self.snapshot:
+            mtime = os.stat(self.snapshot).st_mtime
+            if mtime != self._mtime:
+                self._use(WordSnapshot.open(self.snapshot))
+                self._mtime = mtime
+            self.loaded_at = time.time()
+            return
+
+        self.stats.flush()                      # Make sure counts are current
+
+        with db.checkout():
+            rows = (Word.select(Word.id, Word.text, Word.plays)
+                        .tuples()
+                        .execute())
+            rows = list(rows)
+
+        buf = BytesIO()
+        dump(rows, buf)
+        self._use(WordSnapshot(buf.getvalue()))
+        self.loaded_at = time.time()
+
+    def _use(self, words):
+        self._words = words
+        self._plays = words.plays()
+        self._rebuild_buckets()
+
+    def _rebuild_buckets(self):
+        buckets = {}
+        slots = array('l', [0] * len(self._plays))
+        for idx, count in enumerate(self._plays):
+            bucket = buckets.get(count)
+            if bucket is None:
+                bucket = buckets[count] = array('l')
+            slots[idx] = len(bucket)
+            bucket.append(idx)
+        self._buckets = buckets
+        self._slots = slots
+        self._total_plays = sum(self._plays)
+
+    def _move(self, idx, count):
+        """
+        Moves a word from its current play count bucket into another one.
+        """
+        old = self._buckets[self._plays[idx]]
+
+        # Swap the last entry into the hole left by this word.
+        slot = self._slots[idx]
+        last = old.pop()
+        if last != idx:
+            old[slot] = last
+            self._slots[last] = slot
+        if not old:
+            del self._buckets[self._plays[idx]]
+
+        new = self._buckets.get(count)
+        if new is None:
+            new = self._buckets[count] = array('l')
+        self._slots[idx] = len(new)
+        new.append(idx)
+        self._plays[idx] = count
+
+    def _pick(self):
+        """
+        Picks a random word that has been played no more than the average.
+        """
+        if self.loaded_at is None:
+            self.load()
+
+        if not self._words:
+            raise IndexError('word pool is empty')
+
+        # There are only ever a handful of distinct play counts below the
+        # average, so walking the buckets is cheap.
+        average = self._total_plays / float(len(self._words))
+        eligible = [b for c, b in self._buckets.items() if c <= average]
+        total = sum(len(b) for b in eligible)
+
+        n = random.randrange(total)
+        for bucket in eligible:
+            if n < len(bucket):
+                return bucket[n]
+            n -= len(bucket)
+
+    def deal(self, count, exclude=()):
+        """
+        Chooses up to `count` different under-played words that aren't in
+        `exclude`. Plays aren't counted until the words are played.
+        """
+        seen = set(exclude)
+        words = []
+        for _ in range(count * 10):
+            if len(words) >= count:
+                return words
+            idx = self._pick()                  # May load the words first
+            text = self._words.text(idx)
+            if text not in seen:
+                seen.add(text)
+                words.append(text)
+
+        # Most of the under-played words are taken. Look through the rest.
+        total = len(self._words)
+        start = random.randrange(total)
+        for i in range(total):
+            if len(words) >= count:
+                break
+            text = self._words.text((start + i) % total)
+            if text not in seen:
+                seen.add(text)
+                words.append(text)
+        return words
+
+    def _play(self, idx):
+        self._move(idx, self._plays[idx] + 1)
+        self._total_plays += 1
+        self.stats.play(self._words.word_id(idx))
+
+    def _lookup(self, word):
+        return self._words.find(word)
+
+    def played(self, word):
+        """
+        Counts a play for the given word.
+        """
+        idx = self._lookup(word)
+        if idx is not None:
+            self._play(idx)
+
+    def won(self, word):
+        """
+        Counts a win for the given word.
+        """
+        idx = self._lookup(word)
+        if idx is None:
+            return                              # Not a word we know about
+        self.stats.win(self._words.word_id(idx))
+
+    def run(self):
+        """
+        Periodically reloads the word list.
+        """
+        while True:
+            gevent.sleep(self.refresh_interval)
+            try:
+                self.load()
+            except Exception:
+                log.exception('word pool update failed')
+
+    def start(self):
+        metrics.greenlets.track(gevent.spawn(self.run))
@@ -16,15 +16,38 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+from cStringIO import StringIO
 from itertools import islice
 from peewee import *
+import gzip
+import os
 import sys
+import threading
+import time
+import uuid
+import Queue
+import snapshot
 
 try:
     from models import db, Word
 except KeyError:
     raise Exception('Expects a postgres URL in DATABASE_URL environment variable')
 
+# Part of speech column values, and the ratio each one counts towards
+PARTS_OF_SPEECH = {'n': 'nouns', 'noun': 'nouns', 'nouns': 'nouns',
+                    'v': 'verbs', 'verb': 'verbs', 'verbs': 'verbs',
+                    'a': 'adjectives', 'adj': 'adjectives',
+                    'adjective': 'adjectives', 'adjectives': 'adjectives',
+                    'r': 'adverbs', 'adv': 'adverbs', 'adverb': 'adverbs',
+                    'adverbs': 'adverbs'}
+
+# Prefix for the staging table, which is named uniquely for each import so
+# that imports running at the same time don't share one
+STAGING = 'word_import'
+
+# Parts of speech that --number can be split between
+KINDS = ('nouns', 'verbs', 'adjectives', 'adverbs')
+
 def _grouper(n, iterable):
     it = iter(iterable)
     while True:
@@ -33,16 +56,29 @@ def _grouper(n, iterable):
             return
         yield chunk
 
+def _open(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rU')
+
 def _file_iter(path):
     """
-    Reads a file line by line and filters out empty lines.
+    Reads a file line by line and filters out empty lines. Lines are a word,
+    optionally followed by a tab and its part of speech.
     """
-    with open(path, 'rU') as f:
+    f = _open(path)
+    try:
         for line in f:
             line = line.strip().lower()
             if not line:
                 continue
-            yield line
+            word, _, pos = line.partition('\t')
+            yield word.strip(), pos.strip() or 'noun'
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
 def _calculate_ratios(args):
     """
@@ -57,7 +93,8 @@ def _calculate_ratios(args):
     free = sum(1 for v in ratios.values() if v is None)
     used = sum(v for v in ratios.values() if v is not None)
 
-    free = (1.0 - used) / free
+    if free:
+        free = (1.0 - used) / free
 
     # Convert to absolute numbers
     for k,v in ratios.items():
@@ -70,21 +107,193 @@ def _calculate_ratios(args):
 
     return ratios
 
+def _select(paths, quotas=None):
+    """
+    Yields each distinct word from the given files once. If `quotas` is
+    given, yields no more of each part of speech than it allows.
+    """
+    seen = set()
+    for path in paths:
+        for word, pos in _file_iter(path):
+            if word in seen or len(word) > 255:
+                continue
+            if quotas is not None:
+                kind = PARTS_OF_SPEECH.get(pos)
+                if not quotas.get(kind):
+                    continue
+                quotas[kind] -= 1
+            seen.add(word)
+            yield word
+            if quotas is not None and not any(quotas.values()):
+                return
+
+def _copy_text(words):
+    """
+    Formats words for COPY ... FROM STDIN.
+    """
+    escaped = (w.replace('\\', '\\\\').replace('\t', '\\t')
+                for w in words)
+    return StringIO('\n'.join(escaped) + '\n')
+
+def _connect():
+    import psycopg2
+    return psycopg2.connect(database=db.database, **db.connect_kwargs)
+
+class Progress(object):
+    """Prints rows per second now and then"""
+    def __init__(self, every=1.0):
+        self.every = every
+        self.rows = 0
+        self.start = self.last = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, rows):
+        with self._lock:
+            self.rows += rows
+            now = time.time()
+            if now - self.last >= self.every:
+                self.last = now
+                self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        sys.stderr.write('{:,} rows, {:,.0f} rows/s\n'.format(
+                                            self.rows, self.rows / elapsed))
+
+def _copier(staging, chunks, progress, errors):
+    """
+    COPYs chunks of words into the staging table on a connection of its own.
+    """
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if errors:
+                continue                        # Drain, but don't bother
+            try:
+                cursor.copy_expert('COPY {} (text) FROM STDIN'.format(staging),
+                                    _copy_text(chunk))
+                conn.commit()
+                progress.add(len(chunk))
+            except Exception as e:
+                conn.rollback()
+                errors.append(e)
+    finally:
+        conn.close()
+
+def import_words(paths, quotas=None, jobs=4, batch=50000):
+    """
+    Streams words from the given files into a staging table over `jobs`
+    parallel COPYs, then adds the ones that aren't already in the word table.
+    Returns how many words were added.
+
+    The staging table can't be TEMP, because the COPYs each have their own
+    connection. It's unlogged, named for this import, and dropped afterwards
+    whether or not the import worked.
+    """
+    staging = '{}_{}_{}'.format(STAGING, os.getpid(), uuid.uuid4().hex[:8])
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('CREATE UNLOGGED TABLE {} '
+                        '(text VARCHAR(255) NOT NULL)'.format(staging))
+        conn.commit()
+        try:
+            return _import(conn, staging, paths, quotas, jobs, batch)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(staging))
+            conn.commit()
+    finally:
+        conn.close()
+
+def _import(conn, staging, paths, quotas, jobs, batch):
+    """
+    Does the work for import_words once the staging table exists.
+    """
+    progress = Progress()
+    chunks = Queue.Queue(maxsize=jobs * 2)
+    errors = []
+    threads = [threading.Thread(target=_copier,
+                                args=(staging, chunks, progress, errors))
+                for _ in range(jobs)]
+    for t in threads:
+        t.start()
+    try:
+        for chunk in _grouper(batch, _select(paths, quotas)):
+            if errors:
+                break
+            chunks.put(chunk)
+    finally:
+        for t in threads:
+            chunks.put(None)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    progress.report()
+
+    cursor = conn.cursor()
+    table = Word._meta.db_table
+    cursor.execute('INSERT INTO {0} (text, plays, wins) '
+                    'SELECT text, 0, 0 FROM {1} '
+                    'ON CONFLICT (text) DO NOTHING'.format(table, staging))
+    added = cursor.rowcount
+    conn.commit()
+    return added
+
 def main():
     # Parse command line
     import argparse
     parser = argparse.ArgumentParser(description='Add words to the SketchWithUs database')
-    parser.add_argument('input', help='file containing one word per line')
+    parser.add_argument('input', nargs='*',
+                        help='files containing one word per line, optionally '
+                                'followed by a tab and its part of speech; '
+                                'may be gzipped, or - for stdin')
+    parser.add_argument('-n', '--number', type=int,
+                        help='import this many words, split between parts of '
+                                'speech by the ratios below')
+    for kind in KINDS:
+        parser.add_argument('--' + kind, type=float,
+                            help='fraction of words that are ' + kind)
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='parallel COPY connections')
+    parser.add_argument('--batch', type=int, default=50000,
+                        help='words per COPY')
+    parser.add_argument('--export', metavar='FILE',
+                        help='afterwards, write the word list to a snapshot '
+                                'file for the servers to map')
     args = parser.parse_args()
 
-    # Connect to the database
-    db.connect()
+    quotas = None
+    if args.number is not None:
+        quotas = _calculate_ratios(args)
+    elif any(getattr(args, kind) is not None for kind in KINDS):
+        parser.error('--{} need --number'.format(', --'.join(KINDS)))
+
+    # COPY doesn't work with the wait callback models installs for gevent,
+    # and this runs on plain threads anyway.
+    from psycopg2 import extensions
+    extensions.set_wait_callback(None)
+
+    if args.input:
+        start = time.time()
+        added = import_words(args.input, quotas, jobs=args.jobs,
+                                batch=args.batch)
+        print 'added {:,} new words in {:.1f}s'.format(added,
+                                                        time.time() - start)
+    elif not args.export:
+        parser.error('nothing to import or export')
 
-    # Insert all the words
-    with db.transaction():
-        for chunk in _grouper(1000, _file_iter(args.input)):
-            print chunk
-            Word.insert_many({'text': x, 'plays': 0, 'wins': 0} for x in chunk).execute()
+    if args.export:
+        rows = Word.select(Word.id, Word.text, Word.plays).tuples().execute()
+        snapshot.export(rows, args.export)
+        print 'exported to {}'.format(args.export)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,150 @@
+# Copyright 2014 Sam Wilson <tecywiz121@gmail.com>
+#
+# This file is part of SketchWith.Us.
+#
+# SketchWith.Us is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SketchWith.Us is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SketchWith.Us.  If not, see <http://www.gnu.org/licenses/>.
+import atexit
+import logging
+import time
+import gevent
+from gevent.queue import Queue, Full, Empty
+from models import db, Word
+import metrics
+
+log = logging.getLogger(__name__)
+
+PLAY = 0
+WIN = 1
+
+flushes = metrics.counter('word_stats_flushes_total',
+                            'Bulk updates written to the word table')
+flushed_rows = metrics.counter('word_stats_flushed_rows_total',
+                                'Word rows touched by bulk updates')
+flush_errors = metrics.counter('word_stats_flush_errors_total',
+                                'Bulk updates that failed and were retried')
+dropped = metrics.counter('word_stats_dropped_total',
+                            'Increments dropped because the queue was full')
+flush_latency = metrics.summary('word_stats_flush_seconds',
+                                'Time spent writing a bulk update')
+
+class WordStats(object):
+    """
+    Write-behind aggregator for Word.plays and Word.wins.
+
+    Increments are queued without touching the database, folded together per
+    word by a background greenlet, and written out periodically as a single
+    UPDATE.
+    """
+    def __init__(self, interval=10, maxsize=10000, batch=1000):
+        self.interval = interval                # Seconds between flushes
+        self.batch = batch                      # Flush early past this many
+        self._queue = Queue(maxsize)
+        self._pending = {}                      # Word.id -> [plays, wins]
+        self._greenlet = None
+
+    def play(self, word_id):
+        self._put((PLAY, word_id))
+
+    def win(self, word_id):
+        self._put((WIN, word_id))
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            dropped.inc()
+
+    def _drain(self):
+        """
+        Folds everything currently queued into the pending counts.
+        """
+        while True:
+            try:
+                kind, word_id = self._queue.get_nowait()
+            except Empty:
+                return
+            counts = self._pending.setdefault(word_id, [0, 0])
+            counts[kind] += 1
+
+    def flush(self):
+        """
+        Writes all pending increments to the database as one bulk UPDATE.
+        """
+        self._drain()
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        table = Word._meta.db_table
+        values = ', '.join(['(%s, %s, %s)'] * len(pending))
+        sql = ('UPDATE {0} SET plays = {0}.plays + v.plays, '
+                'wins = {0}.wins + v.wins '
+                'FROM (VALUES {1}) AS v (id, plays, wins) '
+                'WHERE {0}.id = v.id').format(table, values)
+        params = []
+        for word_id, (plays, wins) in pending.items():
+            params.extend((word_id, plays, wins))
+
+        start = time.time()
+        try:
+            with db.checkout(), db.transaction():
+                db.execute_sql(sql, params)
+        except:
+            flush_errors.inc()
+            # Put the counts back so the next flush can try again.
+            for word_id, (plays, wins) in pending.items():
+                counts = self._pending.setdefault(word_id, [0, 0])
+                counts[PLAY] += plays
+                counts[WIN] += wins
+            raise
+        finally:
+            flush_latency.observe(time.time() - start)
+
+        flushes.inc()
+        flushed_rows.inc(len(pending))
+
+    def run(self):
+        deadline = time.time() + self.interval
+        while True:
+            # Wake up early if enough distinct words pile up.
+            timeout = max(0, deadline - time.time())
+            try:
+                kind, word_id = self._queue.get(timeout=timeout)
+            except Empty:
+                pass
+            else:
+                counts = self._pending.setdefault(word_id, [0, 0])
+                counts[kind] += 1
+                if (len(self._pending) < self.batch
+                        and time.time() < deadline):
+                    continue
+
+            deadline = time.time() + self.interval
+            try:
+                self.flush()
+            except Exception:
+                log.exception('flushing word stats failed')
+
+    def close(self):
+        """
+        Stops the background greenlet and writes out whatever is left.
+        """
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+        self.flush()
+
+    def start(self):
+        self._greenlet = metrics.greenlets.track(gevent.spawn(self.run))
+        atexit.register(self.close)